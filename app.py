@@ -1,6 +1,12 @@
+import io
+import re
+import json
+import hashlib
+import threading
+
+import flask
 import dash_bootstrap_components as dbc
 from dash_html_components.P import P
-import plotly.graph_objects as go
 import dash
 import dash_table
 import dash_core_components as dcc
@@ -8,14 +14,238 @@ import dash_html_components as html
 from dash.dependencies import Input, Output, State
 from PIL import Image
 
-from utils import base64_to_img, make_img_graph, byte_png_to_img, resize_img
-from gradcam import gradcam, extract_predictions
+from utils import base64_to_bytes, make_img_graph, img_to_bytes
+import config
+import metrics
+from perturbation import update_shapes, apply_shapes
+from render import resize_img
+import inference
+from sessions import sessions, valid_name
+from store import dequantize, get_file_hash, heatmap_store
+from models import get_spec, registry
+from cache import image_key
+from jobs import get_job_key, get_result, job_store, run_explanation, run_occlusion, submit
+
+# TensorFlow, matplotlib and pandas are imported with the gradcam module on
+# first use, so a worker can answer requests before they are loaded. With an
+# inference worker (see inference.py) they are not imported here at all.
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = "Visual Analytics"
 
 server = app.server
 
+warmed_up = threading.Event()
+
+
+def warm_up_model():
+    inference.warm_up()
+    warmed_up.set()
+
+
+if config.warm_up:
+    # Load the model and trace the kernels in the background
+    threading.Thread(target=warm_up_model, daemon=True).start()
+else:
+    warmed_up.set()
+
+
+@server.route("/ready")
+def ready():
+    # Readiness probe, succeeds once the warm-up inference has finished
+    status = 200 if warmed_up.is_set() else 503
+    return flask.jsonify({"ready": warmed_up.is_set()}), status
+
+
+@server.route("/metrics")
+def prometheus_metrics():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@metrics.register_collector
+def collect_cache():
+    stats = inference.get_stats()["cache"]
+    return [("gradcam_cache_%s_total" % name, "counter", "Explanation cache %s." % name.replace("_", " "),
+             [({}, stats[name])])
+            for name in ("hits", "disk_hits", "misses", "evictions", "disk_evictions")] + [
+        ("gradcam_cache_bytes", "gauge", "Size of the in-memory explanation cache.", [({}, stats["bytes"])]),
+        ("gradcam_cache_entries", "gauge", "Entries in the in-memory explanation cache.",
+         [({}, stats["entries"])]),
+    ]
+
+
+@metrics.register_collector
+def collect_scheduler():
+    # Without importing gradcam, which would load TensorFlow
+    stats = inference.get_stats()["scheduler"]
+    if stats is None:
+        return []
+    return [
+        ("gradcam_scheduler_queue_depth", "gauge", "Requests waiting for a batch.",
+         [({}, stats["queue_depth"])]),
+        ("gradcam_scheduler_batches_total", "counter", "Batches run, by batch size.",
+         [({"batch_size": size}, count) for size, count in stats["batch_size_histogram"].items()]),
+        ("gradcam_scheduler_queue_depth_total", "counter", "Batches run, by queue depth when started.",
+         [({"queue_depth": depth}, count) for depth, count in stats["queue_depth_histogram"].items()]),
+    ]
+
+
+@metrics.register_collector
+def collect_jobs():
+    stats = job_store.stats()
+    return [("gradcam_jobs", "gauge", "Background jobs kept, by status.",
+             [({"status": status}, count) for status, count in stats.items()])]
+
+
+@metrics.register_collector
+def collect_sessions():
+    stats = sessions.stats()
+    return [
+        ("gradcam_sessions", "gauge", "Sessions held in memory.", [({}, stats["sessions"])]),
+        ("gradcam_session_bytes", "gauge", "Memory used by the sessions.", [({}, stats["bytes"])]),
+    ]
+
+
+valid_job_key = re.compile(r"^[0-9a-f]{40}$")
+
+mimetypes = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg", "jpg": "image/jpeg"}
+
+
+@server.route("/session/<session_id>/<name>")
+def session_file(session_id, name):
+    # Images are only sent to the browser once, by URL, instead of being
+    # embedded in the figures passed through the callbacks
+    data = sessions.get_file(session_id, name)
+    if data is None and name == "image.png":
+        img = sessions.get_image(session_id)
+        if img is not None:
+            data = img_to_bytes(img, "PNG")
+            sessions.put_file(session_id, name, data)
+    if data is None:
+        flask.abort(404)
+    response = flask.Response(data, mimetype=mimetypes.get(name.rsplit(".", 1)[-1], "application/octet-stream"))
+    # File names are derived from their content
+    response.headers["Cache-Control"] = "private, max-age=%d, immutable" % config.session_ttl
+    return response
+
+
+@server.route("/jobs/<key>/<name>")
+def job_file(key, name):
+    # Partial and final results of the background jobs, see jobs.py
+    if not valid_job_key.match(key) or not valid_name.match(name):
+        flask.abort(404)
+    data = job_store.read(key, name)
+    if data is None:
+        flask.abort(404)
+    response = flask.Response(data, mimetype=mimetypes.get(name.rsplit(".", 1)[-1], "application/octet-stream"))
+    # Jobs are keyed by their inputs, a result never changes once written
+    response.headers["Cache-Control"] = "private, max-age=%d" % config.job_ttl
+    return response
+
+
+def make_slider_marks(labels):
+    return {i: label for i, label in enumerate(labels)}
+
+
+def make_architecture(blocks):
+    children = []
+    for block in blocks:
+        if children:
+            children.append(html.Div(className="arrow"))
+        children.append(html.Div(html.Div(block, className="conv-block-text"),
+                                 className="conv-block flexbox"))
+    return children
+
+
+def get_model_layers(model_name):
+    # Layer labels and the blocks of the architecture diagram. Layers derived
+    # from the model are only known once it is loaded.
+    spec = get_spec(model_name)
+    if spec.layer_labels:
+        return spec.layer_labels, spec.blocks or spec.layer_labels
+    labels = inference.get_layer_labels(model_name)
+    return labels, labels
+
+
+# Score-CAM runs hundreds of forward passes, the others share one backward pass
+cam_methods = [("gradcam", "Grad-CAM"), ("gradcam++", "Grad-CAM++"), ("layercam", "Layer-CAM"),
+               ("scorecam", "Score-CAM (slow)")]
+
+
+def get_method_options(tiled):
+    # Tiles are explained with the gradient methods only
+    return [{'label': label, 'value': value, 'disabled': tiled and value == "scorecam"}
+            for value, label in cam_methods]
+
+
+default_labels, default_blocks = get_spec().layer_labels or ['top'], get_spec().blocks or []
+
+
+def get_session_image(session_id, relayoutData):
+    # The uploaded image with the drawn shapes burned in on the server
+    img = sessions.get_image(session_id)
+    if img is None:
+        return None, None
+    shapes = update_shapes(sessions.get_shapes(session_id), relayoutData)
+    sessions.set_shapes(session_id, shapes)
+    return apply_shapes(img, shapes), shapes
+
+
+def get_stored_explanation(session_id, selected_class, layer_index, model_name, method):
+    # Table rows and heatmap of the unmodified upload from the heatmap store,
+    # or None if they were not precomputed
+    image_hash = sessions.get_file(session_id, "hash")
+    if heatmap_store is None or image_hash is None:
+        return None
+    model_name = get_spec(model_name).name
+    rank = selected_class[0] if selected_class else 0
+    heatmap = heatmap_store.get(image_hash.decode(), model_name, layer_index, rank=rank, method=method)
+    records = heatmap_store.get_table(image_hash.decode(), model_name)
+    if heatmap is None or records is None:
+        return None
+    return records, dequantize(heatmap)
+
+
+def get_render_name(kind, *params):
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:20]
+    return "%s-%s.%s" % (kind, digest, config.render_format.lower())
+
+
+def serve_render(session_id, name, img):
+    sessions.put_file(session_id, name, img_to_bytes(img, config.render_format))
+    return "/session/%s/%s" % (session_id, name)
+
+
+@server.route("/cache/stats")
+def cache_stats():
+    # hit/miss/eviction counters for sizing the explanation cache
+    return flask.jsonify(inference.get_stats()["cache"])
+
+
+@server.route("/models/stats")
+def model_stats():
+    # resident models and their estimated memory
+    return flask.jsonify(inference.get_stats()["models"])
+
+
+@server.route("/store/stats")
+def store_stats():
+    # precomputed heatmaps and images in the heatmap store
+    return flask.jsonify(heatmap_store.stats() if heatmap_store is not None else {})
+
+
+@server.route("/jobs/stats")
+def job_stats():
+    # background jobs by status
+    return flask.jsonify(job_store.stats())
+
+
+@server.route("/scheduler/stats")
+def scheduler_stats():
+    # batch size and queue depth histograms of the micro-batching scheduler
+    return flask.jsonify(inference.get_stats()["scheduler"] or {})
+
+
 app.layout = html.Div([
     html.H4("1. Upload an image to get started with Grad-CAM"),
     html.Div([
@@ -29,6 +259,7 @@ app.layout = html.Div([
                 className="upload-form",
                 multiple=False
             ),
+            dcc.Store(id='session_id'),
         ], className="flexbox"),
     ], className="container-shadow"),
     html.H4("2. Perturbate your image to influence the model's prediction",
@@ -64,14 +295,52 @@ app.layout = html.Div([
 
                     ),
                 ], className="header-info"),
+                dcc.Dropdown(
+                    id="cam_method",
+                    options=get_method_options(False),
+                    value="gradcam",
+                    clearable=False,
+                ),
+                dcc.Checklist(
+                    id="tiled",
+                    options=[{'label': ' Tiled at full resolution', 'value': 'tiled'}],
+                    value=[],
+                ),
                 html.Div(dcc.Graph(
                     id="heatmap_graph",
                     figure={},
                     style={'display': 'none'},
                 ), id="gradcam-div"),
+                dcc.Store(id='job'),
+                dcc.Interval(id='job_poll', interval=int(config.job_poll_interval * 1000), disabled=True),
             ], className="container-img"
             ),
         ], className="flexbox-row"),
+        html.Div([
+            html.Div([
+                html.Div([
+                    html.H6("Occlusion sweep"),
+                    html.Img(src=app.get_asset_url(
+                        'icon_info.svg'), id="tooltip-occlusion"),
+                    dbc.Tooltip(
+                        "Instead of drawing shapes by hand, hide every patch of the image in turn. Regions where the confidence of the selected class drops the most are highlighted.",
+                        target="tooltip-occlusion",
+                    ),
+                ], className="header-info"),
+                dcc.Dropdown(
+                    id="occlusion_patch",
+                    options=[{'label': '%d px patches' % size, 'value': size}
+                             for size in (16, 32, 56)],
+                    value=16,
+                    clearable=False,
+                ),
+                dbc.Button("Run occlusion sweep", id="occlusion_button",
+                           color="primary", className="space-top"),
+            ], className="container-img"),
+            html.Div(html.Div(id="occlusion-div"), className="container-img"),
+            dcc.Store(id='occlusion_job'),
+            dcc.Interval(id='occlusion_poll', interval=int(config.job_poll_interval * 1000), disabled=True),
+        ], className="flexbox-row space-top"),
         html.Div([
             html.Div([
                 html.H6("Predictions"),
@@ -97,100 +366,34 @@ app.layout = html.Div([
         html.Details([
             html.Summary(
                 html.Div([
-                    html.H6("EfficientNet B0"),
+                    html.H6(get_spec().label, id="model_title"),
                     html.Img(src=app.get_asset_url(
                         'icon_info.svg'), id="tooltip-model"),
                     dbc.Tooltip(
-                        "Select the feature map of the network that will be used for the Grad-CAM calculation.",
+                        "Select the network and the feature map that will be used for the Grad-CAM calculation.",
                         target="tooltip-model",
                     ),
                 ], className="header-info div-summary"),
             ),
             html.Div([
+                dcc.Dropdown(
+                    id="model",
+                    options=[{'label': spec.label, 'value': name} for name, spec in registry.items()],
+                    value=get_spec().name,
+                    clearable=False,
+                ),
                 html.Div(
                     dcc.Slider(
                         id="slider_blocks",
                         min=0,
-                        max=17,
+                        max=len(default_labels) - 1,
                         step=None,
-                        marks={
-                            0: 'stem',
-                            1: '1a',
-                            2: '2a',
-                            3: '2b',
-                            4: '3a',
-                            5: '3b',
-                            6: '4a',
-                            7: '4b',
-                            8: '4c',
-                            9: '5a',
-                            10: '5b',
-                            11: '5c',
-                            12: '6a',
-                            13: '6b',
-                            14: '6c',
-                            15: '6d',
-                            16: '7a',
-                            17: 'top'
-                        },
-                        value=17
+                        marks=make_slider_marks(default_labels),
+                        value=len(default_labels) - 1
                     ), className="slider",
                 ),
-                html.Div([
-                    html.Div(html.Div("Conv3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv1, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 5x5", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("MBConv6, 3x3", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                    html.Div(className="arrow"),
-                    html.Div(html.Div("Conv1x1", className="conv-block-text"),
-                         className="conv-block flexbox"),
-                ], className="model-architecture flexbox-row"),
+                html.Div(make_architecture(default_blocks), id="model-architecture",
+                         className="model-architecture flexbox-row"),
             ], className="flexbox"
             ),
         ], className="space-top"),
@@ -289,44 +492,167 @@ app.layout = html.Div([
 )
 
 
-@app.callback(Output('class_table', 'data'),
-              Input('input_graph', 'relayoutData'),
-              State('input_graph', 'figure'))
-def create_table(relayoutData, figure_dict):
-    if figure_dict:
-        figure = go.Figure(figure_dict)
-        img = figure.to_image(format="png")
-        img = byte_png_to_img(img)
-        df = extract_predictions(img)
-        return df.to_dict('records')
-
-
 @app.callback(Output('input-div', 'children'),
+              Output('session_id', 'data'),
               Input('upload-image', 'contents'))
+@metrics.instrument_callback("set_input_img")
 def set_input_img(image_str):
     if image_str is not None:
-        img = base64_to_img(image_str)
-        img = resize_img(img, 600)
+        data = base64_to_bytes(image_str)
     else:
-        img = Image.open(open("assets/initial_picture.jpg", 'rb'))
-        img = resize_img(img, 600)
-    graph = make_img_graph(img, "input_graph", True)
-    return graph
+        with open("assets/initial_picture.jpg", 'rb') as file:
+            data = file.read()
+    original = Image.open(io.BytesIO(data))
+    img = resize_img(original, 600)
+    # The upload is decoded once and kept on the server, callbacks only pass
+    # the session id and the shape changes
+    session_id = sessions.create(img)
+    if img.size != original.size:
+        # Kept encoded, only tiled explanations decode it again
+        sessions.put_file(session_id, "original", data)
+    if heatmap_store is not None:
+        # Precomputed explanations are found by the hash of the uploaded file
+        sessions.put_file(session_id, "hash", get_file_hash(data).encode())
+    graph = make_img_graph("/session/%s/image.png" % session_id, "input_graph", True)
+    return graph, session_id
+
+
+@app.callback(Output('slider_blocks', 'max'),
+              Output('slider_blocks', 'marks'),
+              Output('slider_blocks', 'value'),
+              Output('model-architecture', 'children'),
+              Output('model_title', 'children'),
+              Input('model', 'value'))
+@metrics.instrument_callback("update_model")
+def update_model(model_name):
+    labels, blocks = get_model_layers(model_name)
+    return (len(labels) - 1, make_slider_marks(labels), len(labels) - 1,
+            make_architecture(blocks), get_spec(model_name).label)
+
+
+@app.callback(Output('cam_method', 'options'),
+              Output('cam_method', 'value'),
+              Input('tiled', 'value'),
+              State('cam_method', 'value'))
+def update_methods(tiled, method):
+    if tiled and method == "scorecam":
+        method = "gradcam"
+    return get_method_options(bool(tiled)), method
 
 
-@app.callback(Output('gradcam-div', 'children'),
-              Input('input_graph', 'figure'),
+def poll_job(key, graph_id):
+    # Table rows, graph, job key and whether to stop polling. Until the job
+    # is done the progress is shown above its partial result, if any.
+    job = job_store.get(key) if key else None
+    if job is None:
+        return dash.no_update, dash.no_update, None, True
+    if job_store.is_stale(job):
+        # Lost with its process, a new submit starts it again
+        job = dict(job, status="failed", message="no progress for %d seconds" % job_store.timeout)
+    if job["status"] == "failed":
+        return dash.no_update, html.Div("The explanation failed: %s" % job["message"],
+                                        className="space-top"), None, True
+    if job["status"] == "done":
+        path, table = get_result(key, "result")
+        if path is not None:
+            return table or dash.no_update, make_img_graph(path, graph_id), None, True
+    path, table = get_result(key, "coarse")
+    progress = dbc.Progress(value=int(job["progress"] * 100), label=job["message"] or job["status"],
+                            striped=True, animated=True, className="space-top")
+    children = [progress] + ([make_img_graph(path, graph_id)] if path is not None else [])
+    return table or dash.no_update, html.Div(children), key, False
+
+
+def submit_explanation(session_id, relayoutData, selected_class, slider_value, model_name, method, tiled):
+    # Tiled explanations start from the upload at its full resolution, which
+    # is passed encoded and decoded by the job
+    shapes = update_shapes(sessions.get_shapes(session_id), relayoutData)
+    sessions.set_shapes(session_id, shapes)
+    source = sessions.get_file(session_id, "original") if tiled else None
+    if source is None:
+        source = apply_shapes(sessions.get_image(session_id), shapes)
+    content = source if isinstance(source, bytes) else image_key(source)
+    params = (shapes, selected_class, slider_value, model_name, method, tiled)
+    key = get_job_key("explanation", content, *params)
+    return submit("explanation", key, run_explanation, source, *params)
+
+
+def is_poll(prop_id):
+    return any(trigger["prop_id"] == prop_id for trigger in dash.callback_context.triggered)
+
+
+@app.callback(Output('class_table', 'data'),
+              Output('gradcam-div', 'children'),
+              Output('job', 'data'),
+              Output('job_poll', 'disabled'),
+              Input('session_id', 'data'),
               Input('class_table', 'selected_rows'),
               Input('slider_blocks', 'value'),
-              Input('input_graph', 'relayoutData'))
-def update_output(figure_dict, selected_class, slider_value, relayoutData):
-    if figure_dict:  # and n_clicks:
-        figure = go.Figure(figure_dict)
-        img = figure.to_image(format="png")
-        img = byte_png_to_img(img)
-        img = gradcam(img, selected_class, slider_value)
-        graph = make_img_graph(img, "gradcam")
-        return graph
+              Input('input_graph', 'relayoutData'),
+              Input('model', 'value'),
+              Input('cam_method', 'value'),
+              Input('tiled', 'value'),
+              Input('job_poll', 'n_intervals'),
+              State('job', 'data'))
+@metrics.instrument_callback("update_output")
+def update_output(session_id, selected_class, slider_value, relayoutData, model_name, method, tiled,
+                  n_intervals, job_key):
+    # Dash allows a single callback per output, so the polling of the
+    # background jobs is handled here as well
+    if is_poll('job_poll.n_intervals'):
+        return poll_job(job_key, "gradcam")
+    if sessions.get_image(session_id) is None:
+        return dash.no_update, dash.no_update, None, True
+    if tiled:
+        key = submit_explanation(session_id, relayoutData, selected_class, slider_value, model_name, method, True)
+        return poll_job(key, "gradcam")
+    img, shapes = get_session_image(session_id, relayoutData)
+    stored = get_stored_explanation(session_id, selected_class, slider_value, model_name, method) \
+        if not shapes else None
+    if stored is not None:
+        records, heatmap = stored
+        name = get_render_name("stored", selected_class, slider_value, model_name, method)
+        if sessions.get_file(session_id, name) is None:
+            serve_render(session_id, name, inference.make_output(img, heatmap))
+        graph = make_img_graph("/session/%s/%s" % (session_id, name), "gradcam")
+        return records, graph, None, True
+    if method == "scorecam":
+        key = submit_explanation(session_id, relayoutData, selected_class, slider_value, model_name, method, False)
+        return poll_job(key, "gradcam")
+    name = get_render_name("gradcam", shapes, selected_class, slider_value, model_name, method)
+    if sessions.get_file(session_id, name) is None:
+        # The table and the heatmap share a single forward pass
+        df, img = inference.explain(img, selected_class, slider_value, model_name, method)
+        serve_render(session_id, name, img)
+    else:
+        df = inference.extract_predictions(img, model_name)
+    graph = make_img_graph("/session/%s/%s" % (session_id, name), "gradcam")
+    return df.to_dict('records'), graph, None, True
+
+
+@app.callback(Output('occlusion-div', 'children'),
+              Output('occlusion_job', 'data'),
+              Output('occlusion_poll', 'disabled'),
+              Input('occlusion_button', 'n_clicks'),
+              Input('occlusion_poll', 'n_intervals'),
+              State('session_id', 'data'),
+              State('input_graph', 'relayoutData'),
+              State('class_table', 'selected_rows'),
+              State('occlusion_patch', 'value'),
+              State('model', 'value'),
+              State('occlusion_job', 'data'))
+@metrics.instrument_callback("update_occlusion")
+def update_occlusion(n_clicks, n_intervals, session_id, relayoutData, selected_class, patch_size, model_name,
+                     job_key):
+    if is_poll('occlusion_poll.n_intervals'):
+        return poll_job(job_key, "occlusion_graph")[1:]
+    img, shapes = get_session_image(session_id, relayoutData) if n_clicks else (None, None)
+    if img is None:
+        return dash.no_update, None, True
+    params = (selected_class, patch_size, model_name)
+    key = get_job_key("occlusion", image_key(img), *params)
+    submit("occlusion", key, run_occlusion, img, *params)
+    return poll_job(key, "occlusion_graph")[1:]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,217 @@
+import os
+import glob
+import time
+import fcntl
+import argparse
+import resource
+import threading
+import multiprocessing
+
+import numpy as np
+
+import config
+from storage import write_atomic
+
+try:
+    # The standalone runtime avoids loading all of TensorFlow
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+quantizations = ("float16", "int8")
+
+
+def get_interpreter_class():
+    if Interpreter is not None:
+        return Interpreter
+    import tensorflow as tf
+    return tf.lite.Interpreter
+
+
+def convert_to_tflite(model, path, quantization="float16"):
+    # Converts the Keras model locally, int8 uses dynamic range quantization of
+    # the weights, so no calibration data is needed
+    import tensorflow as tf
+
+    if quantization not in quantizations:
+        raise ValueError("Unknown quantization %r, expected one of %s" % (quantization, quantizations))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+
+    data = converter.convert()
+    write_atomic(path, lambda file: file.write(data))
+    return path
+
+
+def get_tflite_model(get_model, path, quantization):
+    # Workers warming up together convert the model once, the others wait for
+    # the lock and find the file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            convert_to_tflite(get_model(), path, quantization)
+    return path
+
+
+def get_tflite_path(quantization, model_name=None):
+    model_name = model_name or config.default_model
+    if config.tflite_path and model_name == config.default_model:
+        return config.tflite_path
+    return os.path.join("models", "%s_%s.tflite" % (model_name.lower(), quantization))
+
+
+class KerasBackend:
+    name = "keras"
+
+    def __init__(self, predict):
+        self.predict = predict
+
+
+class TFLiteBackend:
+    name = "tflite"
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        self.num_threads = num_threads
+        # Interpreters are not thread safe, each thread gets its own
+        self.local = threading.local()
+
+    def get_interpreter(self, batch_size):
+        interpreter = getattr(self.local, "interpreter", None)
+        if interpreter is None:
+            interpreter = get_interpreter_class()(model_path=self.path, num_threads=self.num_threads)
+            interpreter.allocate_tensors()
+            self.local.interpreter = interpreter
+            self.local.batch_size = interpreter.get_input_details()[0]["shape"][0]
+        if self.local.batch_size != batch_size:
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(
+                input_details["index"], [batch_size] + list(input_details["shape"][1:]))
+            interpreter.allocate_tensors()
+            self.local.batch_size = batch_size
+        return interpreter
+
+    def predict(self, img_batch):
+        interpreter = self.get_interpreter(len(img_batch))
+        interpreter.set_tensor(interpreter.get_input_details()[0]["index"],
+                               np.asarray(img_batch, dtype=np.float32))
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"]).copy()
+
+
+def make_backend(name, get_model=None, predict=None, model_name=None):
+    # The backend for prediction-only paths. The gradient path always uses the
+    # Keras model, which the tflite backend only loads for the conversion.
+    if name == "keras":
+        return KerasBackend(predict)
+    if name == "tflite":
+        path = get_tflite_model(get_model, get_tflite_path(config.tflite_quantization, model_name),
+                                config.tflite_quantization)
+        return TFLiteBackend(path, config.intra_op_threads or None)
+    raise ValueError("Unknown prediction backend %r" % name)
+
+
+def get_top_classes(preds, k=5):
+    return np.argsort(preds, axis=-1)[:, ::-1][:, :k]
+
+
+def check_agreement(backend, reference, img_batch, k=5):
+    # Agreement of the top-k classes of a backend with the float Keras model
+    top = get_top_classes(backend.predict(img_batch), k)
+    reference_top = get_top_classes(reference.predict(img_batch), k)
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(top, reference_top)]
+    return {
+        "images": len(img_batch),
+        "top1_agreement": float(np.mean(top[:, 0] == reference_top[:, 0])),
+        "top%d_exact_agreement" % k: float(np.mean(np.all(top == reference_top, axis=1))),
+        "top%d_overlap" % k: float(np.mean(overlap)),
+    }
+
+
+def load_check_images(paths, img_size=(224, 224), synthetic=8, seed=0):
+    # Bundled images plus random crops of them, without network access. The
+    # pixels are returned as is, preprocess them for the model.
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for path in paths:
+        img = Image.open(path).convert('RGB')
+        images.append(img.resize(img_size))
+        for _ in range(synthetic):
+            width, height = img.size
+            crop_width, crop_height = int(width * rng.uniform(0.4, 1)), int(height * rng.uniform(0.4, 1))
+            left, top = rng.integers(0, width - crop_width + 1), rng.integers(0, height - crop_height + 1)
+            images.append(img.crop((left, top, left + crop_width, top + crop_height)).resize(img_size))
+    return np.stack([np.asarray(img, dtype=np.float32) for img in images])
+
+
+def get_peak_rss():
+    # in bytes, ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_benchmark(name, path, batch_size, repeats, model_name=None):
+    # Runs in a fresh process, so the resident memory only covers this backend
+    from models import get_spec
+
+    img_size = get_spec(model_name).img_size
+    img_batch = np.random.uniform(0, 255, (batch_size,) + img_size + (3,)).astype(np.float32)
+    if name == "keras":
+        import gradcam
+        backend = KerasBackend(lambda img_batch: gradcam.predict(img_batch, model_name))
+    else:
+        backend = TFLiteBackend(path, config.intra_op_threads or None)
+
+    backend.predict(img_batch)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        backend.predict(img_batch)
+        timings.append(time.perf_counter() - start)
+    return {
+        "backend": name,
+        "batch_size": batch_size,
+        "latency_ms_p50": 1000 * float(np.percentile(timings, 50)),
+        "latency_ms_p90": 1000 * float(np.percentile(timings, 90)),
+        "peak_rss_mb": get_peak_rss() / 2 ** 20,
+    }
+
+
+def benchmark(path, batch_size=1, repeats=20, model_name=None):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in ("keras", "tflite"):
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_benchmark, (name, path, batch_size, repeats, model_name)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert the prediction model to TFLite, check its agreement with "
+                    "the Keras model and compare latency and memory.")
+    parser.add_argument("--model", default=config.default_model)
+    parser.add_argument("--quantization", choices=quantizations, default=config.tflite_quantization)
+    parser.add_argument("--images", nargs="*",
+                        default=["assets/initial_picture.jpg"] + sorted(glob.glob("assets/*.png")))
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    config.tflite_quantization = args.quantization
+
+    import gradcam
+
+    path = convert_to_tflite(gradcam.get_model(args.model).model, get_tflite_path(args.quantization, args.model),
+                             args.quantization)
+    print("Converted model written to %s (%.1f MB)" % (path, os.path.getsize(path) / 2 ** 20))
+    agreement = check_agreement(TFLiteBackend(path),
+                                KerasBackend(lambda img_batch: gradcam.predict(img_batch, args.model)),
+                                gradcam.preprocess_input(
+                                    load_check_images(args.images, gradcam.get_img_size(args.model)), args.model))
+    print("Agreement with the Keras model:", agreement)
+    for result in benchmark(path, args.batch_size, args.repeats, args.model):
+        print(result)
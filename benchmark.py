@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+import platform
+import importlib.util
+import argparse
+
+import numpy as np
+from PIL import Image
+
+import config
+from render import resize_img
+from utils import base64_to_img, img_to_base64, make_img_graph
+
+percentiles = (50, 90, 99)
+
+
+def summarize(timings):
+    timings = 1000 * np.asarray(timings)
+    summary = {"repeats": len(timings), "mean_ms": float(timings.mean()),
+               "min_ms": float(timings.min()), "max_ms": float(timings.max())}
+    for percentile in percentiles:
+        summary["p%d_ms" % percentile] = float(np.percentile(timings, percentile))
+    return summary
+
+
+def measure(function, repeats, warmup=1):
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def make_images(resolutions, seed=0):
+    # The bundled picture and random noise, resized to every resolution
+    rng = np.random.default_rng(seed)
+    picture = Image.open("assets/initial_picture.jpg").convert('RGB')
+    images = []
+    for width, height in resolutions:
+        images.append(("picture", picture.resize((width, height))))
+        noise = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        images.append(("synthetic", Image.fromarray(noise)))
+    return images
+
+
+def has_kaleido():
+    return importlib.util.find_spec("kaleido") is not None
+
+
+def benchmark_images(images, args, record):
+    # Stages that only depend on the input image
+    import gradcam
+
+    layer_names = gradcam.get_layer_names(args.model)
+    for source, img in images:
+        params = {"source": source, "width": img.size[0], "height": img.size[1]}
+        img_str = img_to_base64(img)
+        record("img_to_base64", params, measure(lambda: img_to_base64(img), args.repeats))
+        record("base64_to_img", params, measure(lambda: base64_to_img(img_str).load(), args.repeats))
+        record("resize_img", params, measure(lambda: resize_img(img, 600), args.repeats))
+        record("get_img_array", params, measure(
+            lambda: gradcam.preprocess_input(gradcam.get_img_array(img, args.model), args.model),
+            args.repeats))
+
+        img_array = gradcam.preprocess_input(gradcam.get_img_array(img, args.model), args.model)
+        heatmaps = gradcam.make_gradcam_heatmaps(img_array, model_name=args.model)[1]
+        for layer_index, heatmap in enumerate(heatmaps):
+            layer_params = dict(params, layer=layer_names[layer_index])
+            record("make_gradcam_output", layer_params,
+                   measure(lambda: gradcam.make_gradcam_output(img, heatmap), args.repeats))
+
+        if args.kaleido:
+            figure = make_img_graph(img, "input_graph", True).figure
+            record("figure_to_image", params,
+                   measure(lambda: figure.to_image(format="png"), args.repeats))
+
+
+def benchmark_model(args, record):
+    # Stages that depend on the batch size and layer
+    import tensorflow as tf
+    import gradcam
+
+    loaded = gradcam.get_model(args.model)
+    grad_model = loaded.grad_model
+    for batch_size in args.batch_sizes:
+        img_batch = np.random.default_rng(batch_size).uniform(
+            0, 255, (batch_size,) + loaded.img_size + (3,)).astype(np.float32)
+        params = {"batch_size": batch_size, "execution_mode": gradcam.execution_mode}
+        record("forward", params, measure(lambda: gradcam.predict(img_batch, args.model), args.repeats))
+
+        for layer_index in args.layers:
+            layer_params = dict(params, layer=loaded.layer_names[layer_index])
+
+            # Eager backward pass only, from a recorded forward pass
+            def gradient():
+                with tf.GradientTape() as tape:
+                    outputs = grad_model(img_batch, training=False)
+                    class_channel = tf.reduce_sum(tf.reduce_max(outputs[-1], axis=-1))
+                start = time.perf_counter()
+                tape.gradient(class_channel, outputs[layer_index])
+                return time.perf_counter() - start
+
+            gradient()
+            record("gradient", layer_params, summarize([gradient() for _ in range(args.repeats)]))
+            record("heatmap_kernel", layer_params, measure(
+                lambda: gradcam.make_gradcam_heatmaps_batch(img_batch, None, [layer_index], args.model),
+                args.repeats))
+
+        record("all_layers_kernel", params, measure(
+            lambda: gradcam.make_top_classes_heatmaps_batch(img_batch, model_name=args.model), args.repeats))
+
+
+def get_metadata(args):
+    import tensorflow as tf
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "tensorflow": tf.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "model": args.model,
+        "execution_mode": config.execution_mode,
+        "inter_op_threads": config.inter_op_threads,
+        "intra_op_threads": config.intra_op_threads,
+        "repeats": args.repeats,
+        # Reports without the kaleido figure export lack figure_to_image
+        "kaleido": args.kaleido,
+        "skipped_stages": [] if args.kaleido else ["figure_to_image"],
+    }
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time every stage of the explanation pipeline and write the "
+                    "percentiles as JSON.")
+    parser.add_argument("--model", default=config.default_model,
+                        help="name of a model in models.registry")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--resolutions", type=parse_resolution, nargs="+",
+                        default=[(224, 224), (600, 400), (1920, 1080), (4000, 3000)],
+                        help="input sizes as WIDTHxHEIGHT")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--layers", type=int, nargs="+",
+                        help="indices into the Grad-CAM layers of the model (default: all)")
+    parser.add_argument("--no-kaleido", dest="kaleido", action="store_false",
+                        help="skip the kaleido figure export, which is skipped anyway "
+                             "when kaleido is not installed")
+    parser.add_argument("--output", help="JSON file (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import gradcam
+
+    args = parse_args(argv)
+    if args.kaleido and not has_kaleido():
+        print("kaleido is not installed, skipping figure_to_image", file=sys.stderr)
+        args.kaleido = False
+    if args.layers is None:
+        args.layers = list(range(len(gradcam.get_layer_names(args.model))))
+
+    results = []
+
+    def record(stage, params, summary):
+        results.append(dict(stage=stage, params=params, **summary))
+        print("%-20s %-70s p50 %9.2f ms" % (stage, json.dumps(params), summary["p50_ms"]),
+              file=sys.stderr)
+
+    benchmark_images(make_images(args.resolutions), args, record)
+    benchmark_model(args, record)
+
+    report = {"metadata": get_metadata(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import io
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+from storage import SqliteConnections
+
+
+def image_key(img, *params):
+    # Content address of the decoded pixels plus the explanation parameters
+    key = hashlib.blake2b(digest_size=20)
+    key.update(("%s %r" % (img.mode, img.size)).encode())
+    key.update(img.tobytes())
+    for param in params:
+        key.update(repr(param).encode())
+    return key.hexdigest()
+
+
+def get_size(arrays):
+    return sum(array.nbytes for array in arrays)
+
+
+def serialize(arrays):
+    buffered = io.BytesIO()
+    np.savez(buffered, *arrays)
+    return buffered.getvalue()
+
+
+def deserialize(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return [arrays["arr_%d" % i] for i in range(len(arrays.files))]
+
+
+class DiskCache:
+    # sqlite backed tier, shared by all worker processes on the host
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connections = SqliteConnections(path, [
+            "PRAGMA synchronous=NORMAL",
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)",
+        ])
+
+    def connect(self):
+        return self.connections.get()
+
+    def get(self, key):
+        connection = self.connect()
+        row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        return deserialize(row[0])
+
+    def put(self, key, arrays):
+        connection = self.connect()
+        data = serialize(arrays)
+        connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                           (key, sqlite3.Binary(data), len(data), time.time()))
+        return self.evict()
+
+    def evict(self):
+        # Removes the least recently used entries until the tier fits its budget
+        connection = self.connect()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            rows = connection.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT 32").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+                if total <= self.max_bytes:
+                    break
+        return evicted
+
+    def stats(self):
+        connection = self.connect()
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+
+class ExplanationCache:
+    # LRU of lists of numpy arrays bounded by their size in bytes, optionally
+    # backed by a DiskCache
+
+    def __init__(self, max_bytes, path=None, disk_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.disk = DiskCache(path, disk_max_bytes) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            arrays = self.entries.get(key)
+            if arrays is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return arrays
+
+        if self.disk is not None:
+            arrays = self.disk.get(key)
+            if arrays is not None:
+                self.put_memory(key, arrays)
+                with self.lock:
+                    self.disk_hits += 1
+                return arrays
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, arrays):
+        arrays = list(arrays)
+        self.put_memory(key, arrays)
+        if self.disk is not None:
+            evicted = self.disk.put(key, arrays)
+            with self.lock:
+                self.disk_evictions += evicted
+
+    def put_memory(self, key, arrays):
+        size = get_size(arrays)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= get_size(self.entries.pop(key))
+            self.entries[key] = arrays
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= get_size(evicted)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = list(compute())
+            self.put(key, arrays)
+        return arrays
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        stats = {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+explanation_cache = ExplanationCache(config.cache_max_bytes, config.cache_path,
+                                     config.cache_disk_max_bytes)
@@ -0,0 +1,200 @@
+import io
+import os
+import sys
+import time
+import argparse
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import config
+from render import resize_img
+from gradcam import (get_class_names, get_img_array, get_layer_names, make_gradcam_heatmaps_batch,
+                     make_gradcam_output, preprocess_input)
+from store import HeatmapStore, dtypes, get_file_hash
+from storage import write_atomic
+
+image_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+
+def is_image(name):
+    return name.lower().endswith(image_extensions)
+
+
+def iter_directory(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            if is_image(file):
+                full_path = os.path.join(root, file)
+                yield os.path.relpath(full_path, path), full_path
+
+
+def iter_tar(path):
+    # Streaming mode reads the archive strictly sequentially
+    with tarfile.open(path, "r|*") as archive:
+        for member in archive:
+            if member.isfile() and is_image(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+
+def iter_file_list(path):
+    with open(path) as file_list:
+        for line in file_list:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line, line
+
+
+def iter_images(source):
+    # Yields (name, data) pairs, where data is a path or the encoded bytes
+    if os.path.isdir(source):
+        return iter_directory(source)
+    if tarfile.is_tarfile(source):
+        return iter_tar(source)
+    return iter_file_list(source)
+
+
+def get_output_name(name):
+    # Keeps archive member names from escaping the output directory
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(*parts)
+
+
+def get_output_paths(output, name):
+    # sub/1.jpg is written to heatmaps/sub/1.npy and overlays/sub/1.jpg, is_done
+    # looks for the same paths
+    name = os.path.splitext(get_output_name(name))[0]
+    return (os.path.join(output, "heatmaps", name + ".npy"),
+            os.path.join(output, "overlays", name + ".jpg"))
+
+
+def is_done(output, name):
+    # The heatmap is written last, so its presence marks a finished image
+    return os.path.exists(get_output_paths(output, name)[0])
+
+
+def load_image(name, data, max_width, model_name=None):
+    # Returns the name, the resized image, the model input, the hash of the
+    # encoded file and an error
+    try:
+        if isinstance(data, str):
+            with open(data, "rb") as file:
+                data = file.read()
+        img = Image.open(io.BytesIO(data))
+        img = img.convert('RGB')
+    except (OSError, ValueError) as e:
+        return name, None, None, None, e
+    img_array = get_img_array(img, model_name)
+    return name, resize_img(img, max_width), img_array, get_file_hash(data), None
+
+
+def write_outputs(output, name, img, heatmap, overlays, heatmap_dtype):
+    heatmap_path, overlay_path = get_output_paths(output, name)
+    if overlays:
+        overlay = make_gradcam_output(img, heatmap)
+        write_atomic(overlay_path, lambda file: overlay.save(file, format="JPEG"))
+    write_atomic(heatmap_path, lambda file: np.save(file, heatmap.astype(heatmap_dtype)))
+
+
+def store_explanations(store, items, preds, heatmaps, args):
+    layer_names = get_layer_names(args.model)
+    layer = args.layer % len(layer_names)
+    rank = args.selected_class or 0
+    for (_, _, _, image_hash), image_preds, heatmap in zip(items, preds, heatmaps):
+        class_index = np.argsort(image_preds)[::-1][rank]
+        store.put(image_hash, args.model, args.method, layer, class_index, heatmap, layer_names[layer])
+        store.put_predictions(image_hash, args.model, image_preds, get_class_names(args.model))
+
+
+def explain_batch(items, args, writer, store=None):
+    img_batch = preprocess_input(np.concatenate([item[2] for item in items]), args.model)
+    preds, heatmaps = make_gradcam_heatmaps_batch(
+        img_batch, [args.selected_class] * len(items), [args.layer], args.model, args.method)
+    if store is not None:
+        store_explanations(store, items, preds, heatmaps[0], args)
+    return [writer.submit(write_outputs, args.output, name, img, heatmap,
+                          not args.no_overlays, args.heatmap_dtype)
+            for (name, img, _, _), heatmap in zip(items, heatmaps[0])]
+
+
+def run(args):
+    prefetch = args.prefetch or 4 * args.batch_size
+    processed = skipped = failed = batches = 0
+    start = time.time()
+    store = HeatmapStore(args.store, args.store_dtype) if args.store else None
+
+    pending = deque()
+    writes = []
+    with ThreadPoolExecutor(args.workers) as loader, ThreadPoolExecutor(args.workers) as writer:
+
+        def process_batch():
+            nonlocal processed, failed, batches, writes
+            items = []
+            while pending and len(items) < args.batch_size:
+                name, img, img_array, image_hash, error = pending.popleft().result()
+                if error is not None:
+                    print("Skipping %s: %s" % (name, error), file=sys.stderr)
+                    failed += 1
+                else:
+                    items.append((name, img, img_array, image_hash))
+            if not items:
+                return
+            # Wait for the previous batch to be written so memory stays bounded
+            for write in writes:
+                write.result()
+            writes = explain_batch(items, args, writer, store)
+            processed += len(items)
+            batches += 1
+            if args.log_every and batches % args.log_every == 0:
+                print("%d images, %.1f images/s" % (processed, processed / (time.time() - start)),
+                      file=sys.stderr)
+
+        for name, data in iter_images(args.source):
+            if is_done(args.output, name):
+                skipped += 1
+                continue
+            pending.append(loader.submit(load_image, name, data, args.max_width, args.model))
+            if len(pending) >= prefetch:
+                process_batch()
+        while pending:
+            process_batch()
+        for write in writes:
+            write.result()
+
+    elapsed = time.time() - start
+    print("Explained %d images in %.1fs (%.2f images/s), %d already done, %d failed"
+          % (processed, elapsed, processed / elapsed if elapsed else 0, skipped, failed))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compute Grad-CAM heatmaps and overlays for a directory, "
+                    "a tar archive or a file with one image path per line.")
+    parser.add_argument("source", help="image directory, tar archive or file list")
+    parser.add_argument("output", help="output directory, existing results are skipped")
+    parser.add_argument("--model", default=config.default_model, help="name of a model in models.registry")
+    parser.add_argument("--layer", type=int, default=-1,
+                        help="index into the Grad-CAM layers of the model (default: the last one)")
+    parser.add_argument("--method", choices=["gradcam", "gradcam++", "layercam"], default="gradcam")
+    parser.add_argument("--class", dest="selected_class", type=int, choices=range(5),
+                        help="rank of the explained class among the top 5 (default: top class)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="threads for decoding and writing")
+    parser.add_argument("--prefetch", type=int,
+                        help="images decoded ahead of inference (default: 4 batches)")
+    parser.add_argument("--max-width", type=int, default=800, help="maximum overlay width")
+    parser.add_argument("--no-overlays", action="store_true", help="only write raw heatmaps")
+    parser.add_argument("--heatmap-dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--store", help="also append the heatmaps and predictions to this heatmap store")
+    parser.add_argument("--store-dtype", choices=dtypes, default=config.heatmap_store_dtype)
+    parser.add_argument("--log-every", type=int, default=10, help="log progress every n batches")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -1,3 +1,5 @@
+import os
+
 input_config = {
     'modeBarButtonsToRemove': ['autoScale2d', 'pan2d', 'zoomIn2d', 'zoomOut2d', 'zoom2d',
                                'lasso2d'],
@@ -6,3 +8,103 @@ heatmap_config = {
     'modeBarButtonsToRemove': ['autoScale2d', 'pan2d', 'zoomIn2d', 'zoomOut2d', 'zoom2d',
                                'lasso2d']
 }
+
+# Explanation cache, see cache.py. Setting a cache path enables the sqlite
+# tier shared by all workers on the host.
+cache_max_bytes = int(os.environ.get("GRADCAM_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+cache_path = os.environ.get("GRADCAM_CACHE_PATH")
+cache_disk_max_bytes = int(os.environ.get("GRADCAM_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+
+# How the prediction and heatmap kernels run: "eager", "compiled" (tf.function)
+# or "xla" (tf.function with jit_compile), see gradcam.py
+execution_mode = os.environ.get("GRADCAM_EXECUTION_MODE", "compiled")
+# Trace the kernels with a dummy image when the app starts
+warm_up = os.environ.get("GRADCAM_WARM_UP", "1") == "1"
+
+# TensorFlow thread pools, 0 lets TensorFlow pick
+inter_op_threads = int(os.environ.get("GRADCAM_INTER_OP_THREADS", 1))
+intra_op_threads = int(os.environ.get("GRADCAM_INTRA_OP_THREADS", 0))
+
+# Micro-batching of concurrent explanation requests, see scheduler.py
+batching = os.environ.get("GRADCAM_BATCHING", "1") == "1"
+max_batch_size = int(os.environ.get("GRADCAM_MAX_BATCH_SIZE", 16))
+max_batch_wait = float(os.environ.get("GRADCAM_MAX_BATCH_WAIT", 0.005))
+
+# Backend of the prediction-only paths: "keras" or "tflite". The TFLite model
+# is converted from the Keras weights on first use, see backends.py.
+prediction_backend = os.environ.get("GRADCAM_PREDICTION_BACKEND", "keras")
+tflite_quantization = os.environ.get("GRADCAM_TFLITE_QUANTIZATION", "float16")
+tflite_path = os.environ.get("GRADCAM_TFLITE_PATH")
+
+# Score-CAM scores the input masked by each of the scorecam_channels channels
+# of the layer with the largest variance (0 for all of them), in batches of
+# scorecam_batch_size masked inputs, see gradcam.py
+scorecam_channels = int(os.environ.get("GRADCAM_SCORECAM_CHANNELS", 256))
+scorecam_batch_size = int(os.environ.get("GRADCAM_SCORECAM_BATCH_SIZE", 64))
+
+# Tiled explanations of large images, see tiling.py. Tiles of the model input
+# size overlap by tile_overlap pixels and run in batches of tile_batch_size.
+# Images needing more than max_tiles tiles are scaled down until they fit.
+tile_overlap = int(os.environ.get("GRADCAM_TILE_OVERLAP", 56))
+tile_batch_size = int(os.environ.get("GRADCAM_TILE_BATCH_SIZE", 16))
+max_tiles = int(os.environ.get("GRADCAM_MAX_TILES", 256))
+# Width of the tiled overlays shown in the app
+tiled_render_width = int(os.environ.get("GRADCAM_TILED_RENDER_WIDTH", 1600))
+
+# Directory of precomputed heatmaps, see store.py. Filled by `cli.py --store`
+# and looked up by the app before computing an explanation.
+heatmap_store = os.environ.get("GRADCAM_HEATMAP_STORE")
+heatmap_store_dtype = os.environ.get("GRADCAM_HEATMAP_STORE_DTYPE", "uint8")
+
+# Models are loaded on first use, see models.py. GRADCAM_MODEL_PATH points to
+# a SavedModel or serialized Keras model and GRADCAM_WEIGHTS_PATH to local
+# weights for the default model. Other models use <name>.h5 from
+# GRADCAM_WEIGHTS_DIRECTORY if present. Otherwise the imagenet weights are
+# downloaded.
+default_model = os.environ.get("GRADCAM_DEFAULT_MODEL", "EfficientNetB0")
+model_path = os.environ.get("GRADCAM_MODEL_PATH")
+weights_path = os.environ.get("GRADCAM_WEIGHTS_PATH")
+weights_directory = os.environ.get("GRADCAM_WEIGHTS_DIRECTORY")
+# Estimated memory of the models kept resident at the same time
+max_model_bytes = int(os.environ.get("GRADCAM_MAX_MODEL_BYTES", 512 * 1024 * 1024))
+
+# Sampling profiler for slow callbacks, see metrics.py. Stacks of callbacks
+# slower than the threshold (in seconds) are written to the directory in the
+# collapsed format of flamegraph.pl.
+profile_slow_requests = os.environ.get("GRADCAM_PROFILE_SLOW_REQUESTS", "0") == "1"
+profile_threshold = float(os.environ.get("GRADCAM_PROFILE_THRESHOLD", 1.0))
+profile_interval = float(os.environ.get("GRADCAM_PROFILE_INTERVAL", 0.005))
+profile_directory = os.environ.get("GRADCAM_PROFILE_DIRECTORY", "profiles")
+
+# Server-side session store for uploaded images and rendered heatmaps, see
+# sessions.py. With a directory sessions are shared by all workers on a host.
+session_max_bytes = int(os.environ.get("GRADCAM_SESSION_MAX_BYTES", 256 * 1024 * 1024))
+session_ttl = float(os.environ.get("GRADCAM_SESSION_TTL", 3600))
+session_directory = os.environ.get("GRADCAM_SESSION_DIRECTORY")
+# Format of the heatmaps served to the browser
+render_format = os.environ.get("GRADCAM_RENDER_FORMAT", "WEBP")
+
+# Out-of-process inference, see worker.py. With a socket path the web workers
+# leave the models to a single `python worker.py` on the same host and fall
+# back to running them in-process while it is unreachable.
+inference_socket = os.environ.get("GRADCAM_INFERENCE_SOCKET")
+inference_fallback = os.environ.get("GRADCAM_INFERENCE_FALLBACK", "1") == "1"
+# Seconds the warm-up waits for the worker to come up and between reconnects
+inference_startup_timeout = float(os.environ.get("GRADCAM_INFERENCE_STARTUP_TIMEOUT", 120))
+inference_retry_interval = float(os.environ.get("GRADCAM_INFERENCE_RETRY_INTERVAL", 5))
+# Secret that authenticates the connections to the worker, which unpickles
+# what it receives. Without it the worker writes a random key next to its
+# socket. Both are only accessible to the user running the worker.
+inference_authkey = os.environ.get("GRADCAM_INFERENCE_AUTHKEY")
+
+# Background jobs for slow explanations, see jobs.py. Status and results are
+# kept in the directory for job_ttl seconds, jobs that have not reported
+# progress for job_timeout seconds may be started again.
+job_directory = os.environ.get("GRADCAM_JOB_DIRECTORY", "jobs")
+# Jobs run in threads of each web worker and use its models, or those of the
+# inference worker, so more of them add no model memory, only concurrent work
+job_workers = int(os.environ.get("GRADCAM_JOB_WORKERS", 1))
+job_ttl = float(os.environ.get("GRADCAM_JOB_TTL", session_ttl))
+job_timeout = float(os.environ.get("GRADCAM_JOB_TIMEOUT", 900))
+# Seconds between the progress requests of the browser
+job_poll_interval = float(os.environ.get("GRADCAM_JOB_POLL_INTERVAL", 0.5))
@@ -1,44 +1,67 @@
+import time
+
 import pandas as pd
-from matplotlib import cm
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
-import plotly.express as px
-
-tf.config.threading.set_inter_op_parallelism_threads(1)
-
-model_builder = keras.applications.efficientnet.EfficientNetB0
-img_size = (224, 224)
-preprocess_input = keras.applications.efficientnet.preprocess_input
-decode_predictions = keras.applications.efficientnet.decode_predictions
-
-
-model = model_builder(weights="imagenet")
-
-layer_names = ["stem_activation",
-               "block1a_project_bn",
-               "block2a_project_bn",
-               "block2b_add",
-               "block3a_project_bn",
-               "block3b_add",
-               "block4a_project_bn",
-               "block4b_add",
-               "block4c_add",
-               "block5a_project_bn",
-               "block5b_add",
-               "block5c_add",
-               "block6a_project_bn",
-               "block6b_add",
-               "block6c_add",
-               "block6d_add",
-               "block7a_project_bn",
-               "top_activation"]
-
-
-def get_img_array(img):
+from PIL import Image
+
+import config
+from backends import make_backend
+from cache import explanation_cache, image_key
+from models import get_application_module, get_spec, models
+from metrics import instrument, timed
+from render import render_overlay
+from scheduler import BatchScheduler
+
+tf.config.threading.set_inter_op_parallelism_threads(config.inter_op_threads)
+tf.config.threading.set_intra_op_parallelism_threads(config.intra_op_threads)
+
+# Number of classes in the predictions table
+top_classes = 5
+
+# Input size and Grad-CAM layers of the default model, other models are
+# described in models.py. Derived layers are only known once the model is
+# loaded, see get_layer_names.
+img_size = get_spec().img_size
+layer_names = list(get_spec().layer_names or ())
+
+
+def get_model(model_name=None):
+    return models.get(model_name)
+
+
+def get_model_name(model_name=None):
+    return get_spec(model_name).name
+
+
+def get_img_size(model_name=None):
+    return get_spec(model_name).img_size
+
+
+def get_layer_names(model_name=None):
+    spec = get_spec(model_name)
+    if spec.layer_names:
+        return list(spec.layer_names)
+    return get_model(model_name).layer_names
+
+
+def get_layer_labels(model_name=None):
+    spec = get_spec(model_name)
+    if spec.layer_labels:
+        return list(spec.layer_labels)
+    return get_model(model_name).layer_labels
+
+
+def preprocess_input(img_array, model_name=None):
+    return get_application_module(get_spec(model_name)).preprocess_input(img_array)
+
+
+@instrument("get_img_array")
+def get_img_array(img, model_name=None):
     img = img.convert('RGB')
 
-    img = img.resize(img_size)
+    img = img.resize(get_img_size(model_name))
 
     array = keras.preprocessing.image.img_to_array(img)
 
@@ -46,96 +69,515 @@ def get_img_array(img):
     return array
 
 
-def extract_predictions(img_array):
-    img_array = get_img_array(img_array)
-
-    preds = model.predict(img_array)
-
+def make_predictions_table(preds, model_name=None):
     # get 5 highest classes
-    resulting_classes = decode_predictions(preds, top=5)
-    df = pd.DataFrame(columns=["class", "confidence"])
-    i = 0
-    for c in resulting_classes[0]:
-        df.loc[i] = [c[1].replace("_", " ").title(), round(
-            float(c[2]), 3)]  # round for better visibility
-        i += 1
+    decode_predictions = get_application_module(get_spec(model_name)).decode_predictions
+    resulting_classes = decode_predictions(preds, top=top_classes)[0]
+    _, names, confidences = zip(*resulting_classes)
+    df = pd.DataFrame({
+        "class": [name.replace("_", " ").title() for name in names],
+        # round for better visibility
+        "confidence": np.round(np.asarray(confidences, dtype=float), 3)
+    })
     return df
 
 
-def make_gradcam_heatmap(img_array, pred_index=None, layer_index=-1):
-    layer_name = layer_names[layer_index]
-    # First, we create a model that maps the input image to the activations
-    # of the last conv layer as well as the output predictions
-    grad_model = tf.keras.models.Model(
-        [model.inputs], [model.get_layer(
-            layer_name).output, model.output]
-    )
+def get_predictions(img, model_name=None):
+    model_name = get_model_name(model_name)
 
-    # Then, we compute the gradient of the top predicted class for our input image
-    # with respect to the activations of the last conv layer
-    with tf.GradientTape() as tape:
-        last_conv_layer_output, preds = grad_model(img_array)
+    def compute():
+        img_array = get_img_array(img, model_name)
+        return [get_prediction_backend(model_name).predict(preprocess_input(img_array, model_name))]
 
-        if pred_index is None:
-            pred_index = tf.argmax(preds[0])
-        else:
-            selected_pred = tf.squeeze(preds)
-            top_five_classes = tf.argsort(selected_pred)[-5:][::-1]
-            pred_index = top_five_classes[pred_index]
-        class_channel = preds[:, pred_index]
+    preds, = explanation_cache.get_or_compute(image_key(img, "predictions", model_name), compute)
+    return preds
 
-    # This is the gradient of the output neuron (top predicted or chosen)
-    # with regard to the output feature map of the last conv layer
-    grads = tape.gradient(class_channel, last_conv_layer_output)
 
-    # This is a vector where each entry is the mean intensity of the gradient
-    # over a specific feature map channel
+def get_class_names(model_name=None):
+    # Display names of all classes by index
+    spec = get_spec(model_name)
+    if spec.module not in class_names:
+        decoded = get_application_module(spec).decode_predictions(np.eye(1000, dtype=np.float32), top=1)
+        class_names[spec.module] = [row[0][1] for row in decoded]
+    return class_names[spec.module]
 
-    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
 
-    # We multiply each channel in the feature map array
-    # by "how important this channel is" with regard to the top predicted class
-    # then sum all the channels to obtain the heatmap class activation
-    last_conv_layer_output = last_conv_layer_output[0]
+class_names = {}
 
-    heatmap = last_conv_layer_output @ pooled_grads[..., tf.newaxis]
 
-    heatmap = tf.squeeze(heatmap)
+def extract_predictions(img_array, model_name=None):
+    preds = get_predictions(img_array.convert('RGB'), model_name)
+    return make_predictions_table(preds, model_name)
 
-    # For visualization purpose, we will also normalize the heatmap between 0 & 1
-    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
-    return heatmap.numpy()
 
+def get_selected_index(selected_class):
+    # The table passes its selected rows as a list
+    if isinstance(selected_class, (list, tuple)):
+        selected_class = selected_class[0] if selected_class else None
+    return selected_class
 
-def make_gradcam_output(img, heatmap, alpha=0.4):
-    # Rescale heatmap to a range 0-255
-    heatmap = np.uint8(255 * heatmap)
 
-    img_array = keras.preprocessing.image.img_to_array(img)
+# Kernels run either eagerly op by op, as a traced graph or compiled with XLA.
+# Their inputs have fixed signatures, so every kernel is traced only once per
+# model. The kernels live with the loaded model and go when it is evicted.
+execution_modes = ("eager", "compiled", "xla")
+execution_mode = None
+rank_signature = tf.TensorSpec(shape=(None,), dtype=tf.int32)
 
-    # Use jet colormap to colorize heatmap
-    jet = cm.get_cmap("jet")
 
-    # Use RGB values of the colormap
-    jet_colors = jet(np.arange(256))[:, :3]
-    jet_heatmap = jet_colors[heatmap]
+def set_execution_mode(mode):
+    global execution_mode
+    if mode not in execution_modes:
+        raise ValueError("Unknown execution mode %r, expected one of %s" % (mode, execution_modes))
+    execution_mode = mode
+
+
+set_execution_mode(config.execution_mode)
+
+
+def compile_kernel(function, input_signature):
+    if execution_mode == "eager":
+        return function
+    return tf.function(function, input_signature=input_signature,
+                       jit_compile=execution_mode == "xla")
+
+
+def get_image_signature(loaded):
+    return tf.TensorSpec(shape=(None,) + loaded.img_size + (3,), dtype=tf.float32)
+
+
+def get_kernel(loaded, name, make_kernel, input_signature, *params):
+    key = (execution_mode, name) + params
+    if key not in loaded.kernels:
+        loaded.kernels[key] = compile_kernel(make_kernel(loaded, *params), input_signature)
+    return loaded.kernels[key]
+
+
+def make_predict_kernel(loaded):
+    def predict_kernel(img_batch):
+        return loaded.model(img_batch, training=False)
+    return predict_kernel
 
-    # Create an image with RGB colorized heatmap
-    jet_heatmap = keras.preprocessing.image.array_to_img(jet_heatmap)
-    jet_heatmap = jet_heatmap.resize((img_array.shape[1], img_array.shape[0]))
-    jet_heatmap = keras.preprocessing.image.img_to_array(jet_heatmap)
-    img_array = img_array[:, :, :3]
-    # Superimpose the heatmap on original image
-    superimposed_img = jet_heatmap * alpha + img_array
-    superimposed_img = keras.preprocessing.image.array_to_img(superimposed_img)
 
-    return superimposed_img
+def weigh_activations(layer_output, layer_grads, method):
+    # Combines the activations of shape (batch, height, width, channels) with
+    # the gradients of k classes of shape (k, batch, height, width, channels)
+    # into maps of shape (batch, k, height, width)
+    if method == "layercam":
+        # Layer-CAM weighs every position by its own positive gradient, which
+        # keeps the fine detail of early layers
+        return tf.einsum("nhwc,knhwc->nkhw", layer_output, tf.nn.relu(layer_grads))
+    if method == "gradcam++":
+        # Grad-CAM++ weighs the positive gradients by alpha, computed in
+        # closed form from the second and third powers of the gradient
+        grads_2 = tf.square(layer_grads)
+        grads_3 = grads_2 * layer_grads
+        activation_sums = tf.reduce_sum(layer_output, axis=(1, 2))[tf.newaxis, :, tf.newaxis, tf.newaxis]
+        alpha = tf.math.divide_no_nan(grads_2, 2 * grads_2 + activation_sums * grads_3)
+        weights = tf.reduce_sum(alpha * tf.nn.relu(layer_grads), axis=(2, 3))
+        return tf.einsum("nhwc,knc->nkhw", layer_output, weights)
+    # This is a vector per image where each entry is the mean intensity of
+    # the gradient over a specific feature map channel
+    pooled_grads = tf.reduce_mean(layer_grads, axis=(2, 3))
+
+    # We multiply each channel in the feature map array
+    # by "how important this channel is" with regard to the top predicted class
+    # then sum all the channels to obtain the heatmap class activation
+    return tf.einsum("nhwc,knc->nkhw", layer_output, pooled_grads)
+
+
+def normalize_heatmaps(heatmaps):
+    # For visualization purpose, we will also normalize the heatmap between 0 & 1
+    heatmaps = tf.maximum(heatmaps, 0)
+    return tf.math.divide_no_nan(heatmaps, tf.math.reduce_max(heatmaps, axis=(-2, -1), keepdims=True))
+
+
+def make_heatmap_kernel(loaded, layer_indices, method="gradcam"):
+    def heatmap_kernel(img_batch, ranks):
+        # Compute the gradient of the top predicted (or chosen) classes for our
+        # input images with respect to the activations of all layers at once
+        with tf.GradientTape() as tape:
+            outputs = loaded.grad_model(img_batch, training=False)
+            layer_outputs = [outputs[i] for i in layer_indices]
+            preds = outputs[-1]
+
+            top_classes_indices = tf.math.top_k(preds, k=top_classes).indices
+            class_indices = tf.gather(top_classes_indices, ranks, batch_dims=1)
+            class_channel = tf.gather(preds, class_indices, batch_dims=1)
+            # The images are independent, so the gradient of the sum holds the
+            # gradient of every image with respect to its own activations
+            class_channel = tf.reduce_sum(class_channel)
+
+        grads = tape.gradient(class_channel, layer_outputs)
+
+        heatmaps = [normalize_heatmaps(weigh_activations(layer_output, layer_grads[tf.newaxis], method)[:, 0])
+                    for layer_output, layer_grads in zip(layer_outputs, grads)]
+        return preds, heatmaps
+    return heatmap_kernel
+
+
+def make_top_classes_heatmap_kernel(loaded, layer_indices, top_k, methods=("gradcam",)):
+    def top_classes_heatmap_kernel(img_batch):
+        # Heatmaps of the top_k classes from a single forward pass: the jacobian
+        # of the top_k class scores takes all their gradients in one batched
+        # backward pass. The gradient methods only weigh them differently.
+        with tf.GradientTape() as tape:
+            outputs = loaded.grad_model(img_batch, training=False)
+            layer_outputs = [outputs[i] for i in layer_indices]
+            preds = outputs[-1]
+
+            top_classes = tf.math.top_k(preds, k=top_k).indices
+            class_channels = tf.gather(preds, top_classes, batch_dims=1)
+            # One target per rank, summed over the independent images
+            class_channels = tf.reduce_sum(class_channels, axis=0)
+
+        # Each of shape (top_k, batch, height, width, channels)
+        grads = tape.jacobian(class_channels, layer_outputs)
+
+        heatmaps = [[normalize_heatmaps(weigh_activations(layer_output, layer_grads, method))
+                     for layer_output, layer_grads in zip(layer_outputs, grads)]
+                    for method in methods]
+        return preds, heatmaps
+    return top_classes_heatmap_kernel
+
+
+def make_activations_kernel(loaded, layer_index):
+    def activations_kernel(img_batch):
+        outputs = loaded.grad_model(img_batch, training=False)
+        return outputs[layer_index], outputs[-1]
+    return activations_kernel
+
+
+@instrument("forward")
+def predict(img_batch, model_name=None):
+    loaded = get_model(model_name)
+    kernel = get_kernel(loaded, "predict", make_predict_kernel, [get_image_signature(loaded)])
+    return kernel(tf.convert_to_tensor(img_batch, dtype=tf.float32)).numpy()
+
+
+def get_prediction_backend(model_name=None):
+    # Prediction-only paths may run on a lighter backend than the Keras model
+    loaded = get_model(model_name)
+    if loaded.prediction_backend is None:
+        loaded.prediction_backend = make_backend(
+            config.prediction_backend, lambda: loaded.model,
+            lambda img_batch: predict(img_batch, loaded.name), loaded.name)
+    return loaded.prediction_backend
+
+
+# Methods computed from the gradients of a single backward pass, Score-CAM
+# needs forward passes of masked images instead
+gradient_methods = ("gradcam", "gradcam++", "layercam")
+methods = gradient_methods + ("scorecam",)
+
+
+def check_method(method, allowed=methods):
+    if method not in allowed:
+        raise ValueError("Unknown CAM method %r, expected one of %s" % (method, allowed))
+
+
+def get_layer_indices(loaded, layer_indices):
+    if layer_indices is None:
+        layer_indices = range(len(loaded.layer_names))
+    return tuple(index % len(loaded.layer_names) for index in layer_indices)
+
+
+@instrument("heatmaps")
+def make_gradcam_heatmaps_batch(img_batch, pred_indices=None, layer_indices=None, model_name=None,
+                                method="gradcam"):
+    # Computes the heatmaps of a batch of images at the layers in layer_indices
+    # (all by default) and returns them together with the predictions, since
+    # both come out of the same forward pass. pred_indices selects a class per
+    # image by its rank among the top 5 predictions, None meaning the top class.
+    check_method(method, gradient_methods)
+    loaded = get_model(model_name)
+    layer_indices = get_layer_indices(loaded, layer_indices)
+    if pred_indices is None:
+        pred_indices = [None] * len(img_batch)
+    ranks = tf.constant([0 if index is None else index for index in pred_indices], dtype=tf.int32)
+
+    kernel = get_kernel(loaded, "heatmaps", make_heatmap_kernel,
+                        [get_image_signature(loaded), rank_signature], layer_indices, method)
+    preds, heatmaps = kernel(tf.convert_to_tensor(img_batch, dtype=tf.float32), ranks)
+    return preds.numpy(), [heatmap.numpy() for heatmap in heatmaps]
+
+
+@instrument("top_classes_heatmaps")
+def make_top_classes_heatmaps_by_method(img_batch, layer_indices=None, top_k=top_classes, model_name=None,
+                                        methods=gradient_methods):
+    # Heatmaps of the top_k classes for several gradient methods, which share
+    # the forward pass and the jacobian. Returns the predictions and a dict of
+    # the heatmaps of every method.
+    methods = tuple(methods)
+    for method in methods:
+        check_method(method, gradient_methods)
+    loaded = get_model(model_name)
+    layer_indices = get_layer_indices(loaded, layer_indices)
+
+    kernel = get_kernel(loaded, "top_classes_heatmaps", make_top_classes_heatmap_kernel,
+                        [get_image_signature(loaded)], layer_indices, top_k, methods)
+    preds, heatmaps = kernel(tf.convert_to_tensor(img_batch, dtype=tf.float32))
+    return preds.numpy(), {method: [heatmap.numpy() for heatmap in method_heatmaps]
+                           for method, method_heatmaps in zip(methods, heatmaps)}
+
+
+def make_top_classes_heatmaps_batch(img_batch, layer_indices=None, top_k=top_classes, model_name=None,
+                                    method="gradcam"):
+    # Like make_gradcam_heatmaps_batch, but for each of the top_k classes at
+    # once. Every heatmap has shape (batch, top_k, height, width).
+    preds, heatmaps = make_top_classes_heatmaps_by_method(img_batch, layer_indices, top_k, model_name, (method,))
+    return preds, heatmaps[method]
+
+
+def get_activations(img_array, layer_index=-1, model_name=None):
+    # Activations of a layer and the predictions, from one forward pass
+    loaded = get_model(model_name)
+    kernel = get_kernel(loaded, "activations", make_activations_kernel, [get_image_signature(loaded)],
+                        layer_index % len(loaded.layer_names))
+    activations, preds = kernel(tf.convert_to_tensor(img_array, dtype=tf.float32))
+    return activations.numpy(), preds.numpy()
+
+
+@instrument("score_cam")
+def make_score_cam_heatmap(img_array, pred_index=None, layer_index=-1, model_name=None,
+                           channels=None, batch_size=None, activations=None, preds=None):
+    # Score-CAM weighs every channel of the layer by the class score of the
+    # input masked with that channel, upsampled and scaled to 0-1. Only the
+    # channels with the largest spatial variance are scored (all with
+    # channels=0), constant channels would not mask anything. The masked
+    # inputs go through the prediction backend in batches of batch_size.
+    # activations and preds of the image may be passed if already computed.
+    loaded = get_model(model_name)
+    layer_index = layer_index % len(loaded.layer_names)
+    channels = config.scorecam_channels if channels is None else channels
+    batch_size = batch_size or config.scorecam_batch_size
+    img_array = tf.convert_to_tensor(img_array, dtype=tf.float32)
+
+    if activations is None or preds is None:
+        activations, preds = get_activations(img_array, layer_index, model_name)
+    activations = tf.convert_to_tensor(activations[0], dtype=tf.float32)
+    class_index = np.argsort(preds[0])[::-1][pred_index or 0]
+
+    if channels and channels < activations.shape[-1]:
+        variances = tf.math.reduce_variance(activations, axis=(0, 1))
+        activations = tf.gather(activations, tf.math.top_k(variances, k=channels).indices, axis=-1)
+
+    backend = get_prediction_backend(model_name)
+    weights = np.empty(activations.shape[-1], dtype=np.float32)
+    for start in range(0, activations.shape[-1], batch_size):
+        # Upsample and scale a whole chunk of channels at once
+        masks = tf.image.resize(activations[tf.newaxis, :, :, start:start + batch_size], loaded.img_size)[0]
+        low = tf.reduce_min(masks, axis=(0, 1))
+        masks = tf.math.divide_no_nan(masks - low, tf.reduce_max(masks, axis=(0, 1)) - low)
+        masked = tf.transpose(masks, (2, 0, 1))[..., tf.newaxis] * img_array
+        weights[start:start + len(masked)] = backend.predict(masked.numpy())[:, class_index]
+
+    heatmap = normalize_heatmaps(tf.einsum("hwc,c->hw", activations, weights))
+    return preds, heatmap.numpy()
+
+
+def warm_up(model_name=None):
+    # Traces the kernels the app uses, so the first request does not pay for it
+    img_batch = np.zeros((1,) + get_img_size(model_name) + (3,), dtype=np.float32)
+    get_prediction_backend(model_name).predict(img_batch)
+    make_top_classes_heatmaps_by_method(img_batch, model_name=model_name)
+
+
+def compare_execution_modes(repeats=10, batch_size=1, modes=execution_modes, model_name=None):
+    # Median latency in seconds of the prediction and heatmap kernels per mode
+    previous_mode = execution_mode
+    img_batch = np.random.uniform(
+        0, 255, (batch_size,) + get_img_size(model_name) + (3,)).astype(np.float32)
+    results = {}
+    try:
+        for mode in modes:
+            set_execution_mode(mode)
+            results[mode] = {}
+            for name, run in [("predictions", lambda: predict(img_batch, model_name)),
+                              ("heatmaps", lambda: make_gradcam_heatmaps_batch(
+                                  img_batch, model_name=model_name))]:
+                run()
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - start)
+                results[mode][name] = float(np.median(timings))
+    finally:
+        set_execution_mode(previous_mode)
+    return results
+
+
+def make_gradcam_heatmaps(img_array, pred_index=None, model_name=None, method="gradcam"):
+    preds, heatmaps = make_gradcam_heatmaps_batch(img_array, [pred_index], model_name=model_name,
+                                                  method=method)
+    return preds, [heatmap[0] for heatmap in heatmaps]
+
+
+def compute_explanations(items):
+    # Explains the images of concurrent requests as one batch per model, with
+    # the heatmaps of all gradient methods
+    results = [None] * len(items)
+    for model_name in set(model_name for model_name, _ in items):
+        indices = [i for i, item in enumerate(items) if item[0] == model_name]
+        img_batch = np.concatenate([items[i][1] for i in indices])
+        preds, heatmaps = make_top_classes_heatmaps_by_method(img_batch, model_name=model_name)
+        for j, i in enumerate(indices):
+            results[i] = (preds[j:j + 1], {method: [heatmap[j] for heatmap in method_heatmaps]
+                                           for method, method_heatmaps in heatmaps.items()})
+    return results
+
+
+scheduler = BatchScheduler(compute_explanations, config.max_batch_size, config.max_batch_wait)
+
+
+def get_explanations(img, model_name=None, method="gradcam"):
+    # Predictions and the heatmaps of all layers for each class of the
+    # predictions table, cached by the pixels of the image, the model and the
+    # method. Selecting a class or moving the layer slider is only a lookup.
+    # The gradient methods share the forward and backward pass, so all of them
+    # are computed and cached at once and switching the method is a lookup too.
+    check_method(method, gradient_methods)
+    model_name = get_model_name(model_name)
+    explanation = explanation_cache.get(image_key(img, "top_classes", model_name, method))
+    if explanation is None:
+        img_array = get_img_array(img, model_name)
+        with timed("preprocess_input", img=img):
+            img_array = preprocess_input(img_array, model_name)
+        if config.batching:
+            preds, heatmaps = scheduler.submit(model_name, img_array).result()
+        else:
+            preds, heatmaps = make_top_classes_heatmaps_by_method(img_array, model_name=model_name)
+            heatmaps = {name: [heatmap[0] for heatmap in method_heatmaps]
+                        for name, method_heatmaps in heatmaps.items()}
+        for name, method_heatmaps in heatmaps.items():
+            explanation_cache.put(image_key(img, "top_classes", model_name, name), [preds] + method_heatmaps)
+        explanation = [preds] + heatmaps[method]
+        explanation_cache.put(image_key(img, "predictions", model_name), [preds])
+    return explanation[0], explanation[1:]
+
+
+def get_explanation(img, pred_index=None, model_name=None, method="gradcam"):
+    # Predictions and the heatmaps of all layers for the selected class
+    preds, heatmaps = get_explanations(img, model_name, method)
+    rank = 0 if pred_index is None else pred_index
+    return preds, [heatmap[rank] for heatmap in heatmaps]
+
+
+def get_heatmap(img, pred_index=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Predictions, the heatmap of the selected class and layer and the index
+    # of the layer. Score-CAM is computed for this layer only, the gradient
+    # methods for all layers at once.
+    check_method(method)
+    if method != "scorecam":
+        preds, heatmaps = get_explanation(img, pred_index, model_name, method)
+        return preds, heatmaps[layer_index], layer_index % len(heatmaps)
+
+    model_name = get_model_name(model_name)
+    layer_index = layer_index % len(get_layer_names(model_name))
+    key = image_key(img, "scorecam", model_name, pred_index, layer_index,
+                    config.scorecam_channels)
+
+    def compute():
+        img_array = preprocess_input(get_img_array(img, model_name), model_name)
+        # The forward pass is shared by all classes of the layer
+        activations, preds = explanation_cache.get_or_compute(
+            image_key(img, "activations", model_name, layer_index),
+            lambda: get_activations(img_array, layer_index, model_name))
+        return make_score_cam_heatmap(img_array, pred_index, layer_index, model_name,
+                                      activations=activations, preds=preds)
+
+    preds, heatmap = explanation_cache.get_or_compute(key, compute)
+    return preds, heatmap, layer_index
+
+
+def make_gradcam_heatmap(img_array, pred_index=None, layer_index=-1, model_name=None, method="gradcam"):
+    pred_index = get_selected_index(pred_index)
+    if method == "scorecam":
+        return make_score_cam_heatmap(img_array, pred_index, layer_index, model_name)[1]
+    _, heatmaps = make_gradcam_heatmaps(img_array, pred_index, model_name, method)
+    return heatmaps[layer_index]
+
+
+def make_gradcam_output(img, heatmap, alpha=0.4, colormap="jet", method="bilinear"):
+    # Superimpose the heatmap on original image
+    return Image.fromarray(render_overlay(img, heatmap, alpha, colormap, method))
 
 
-def gradcam(img, selected_class=None, layer_index=-1):
+def gradcam(img, selected_class=None, layer_index=-1, model_name=None, method="gradcam"):
+    # method is one of "gradcam", "gradcam++", "layercam" or "scorecam"
     img = img.convert('RGB')
-    img_array = get_img_array(img)
-    img_array_pre = preprocess_input(img_array.copy())
-    heatmap = make_gradcam_heatmap(img_array_pre, selected_class, layer_index)
-    img = make_gradcam_output(img, heatmap)
+    _, heatmap, layer = get_heatmap(img, get_selected_index(selected_class), layer_index, model_name, method)
+    with timed("render", layer, img):
+        img = make_gradcam_output(img, heatmap)
     return img
+
+
+def explain(img, selected_class=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Predictions table and CAM overlay from a single forward pass
+    img = img.convert('RGB')
+    preds, heatmap, layer = get_heatmap(img, get_selected_index(selected_class), layer_index, model_name,
+                                        method)
+    df = make_predictions_table(preds, model_name)
+    with timed("render", layer, img):
+        img = make_gradcam_output(img, heatmap)
+    return df, img
+
+
+def get_batch_item(images, i):
+    img = images[i]
+    if isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
+    return img.convert('RGB')
+
+
+def get_per_item(value, n):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        if len(value) != n:
+            raise ValueError("Expected %d selections, got %d" % (n, len(value)))
+        return list(value)
+    return [value] * n
+
+
+def gradcam_batch(images, selected_classes=None, layer_indices=-1, batch_size=32, overlays=True,
+                  model_name=None, method="gradcam"):
+    # Explains a list of PIL images or an uint8 array of shape (n, height, width, 3)
+    # with a class and layer selection per image (or one for all of them).
+    # Returns the predictions, the heatmap of every image and, if requested,
+    # the heatmaps superimposed on the images.
+    n = len(images)
+    selected_classes = [get_selected_index(c) for c in get_per_item(selected_classes, n)]
+    n_layers = len(get_layer_names(model_name))
+    layer_indices = [index % n_layers for index in get_per_item(layer_indices, n)]
+
+    preds = []
+    heatmaps = []
+    outputs = [] if overlays else None
+    for start in range(0, n, batch_size):
+        batch = range(start, min(start + batch_size, n))
+        batch_images = [get_batch_item(images, i) for i in batch]
+        img_batch = np.concatenate([get_img_array(img, model_name) for img in batch_images])
+        img_batch = preprocess_input(img_batch, model_name)
+
+        batch_layers = sorted(set(layer_indices[i] for i in batch))
+        batch_preds, batch_heatmaps = make_gradcam_heatmaps_batch(
+            img_batch, [selected_classes[i] for i in batch], batch_layers, model_name, method)
+        preds.append(batch_preds)
+
+        for j, i in enumerate(batch):
+            heatmap = batch_heatmaps[batch_layers.index(layer_indices[i])][j]
+            heatmaps.append(heatmap)
+            if overlays:
+                outputs.append(make_gradcam_output(batch_images[j], heatmap))
+
+    preds = np.concatenate(preds) if preds else np.zeros((0, 1000), dtype=np.float32)
+    return preds, heatmaps, outputs
+
+
+if __name__ == '__main__':
+    # Compare eager and compiled latency on this machine
+    import sys
+
+    for mode, timings in compare_execution_modes(model_name=sys.argv[1] if len(sys.argv) > 1 else None).items():
+        print("%-8s predictions %7.1f ms   heatmaps %7.1f ms"
+              % (mode, 1000 * timings["predictions"], 1000 * timings["heatmaps"]))
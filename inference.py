@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import numpy as np
+from PIL import Image
+
+import config
+from metrics import timed
+from render import downsample_heatmap, render_overlay, resize_img
+
+# Entry points of the app that run the models either in this process or in
+# the inference worker (worker.py). Arrays are exchanged through files in
+# shared memory that both processes map, only their layout goes through the
+# socket.
+
+shm_directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+def write_arrays(arrays):
+    # Copies the arrays into a new shared memory file and returns its path
+    # and the (shape, dtype, offset) of every array
+    arrays = [np.asarray(array) for array in arrays]
+    layout = []
+    size = 0
+    for array in arrays:
+        layout.append((array.shape, array.dtype.str, size))
+        # keep every array aligned
+        size += -(-array.nbytes // 64) * 64
+    fd, path = tempfile.mkstemp(prefix="gradcam-", dir=shm_directory)
+    try:
+        os.ftruncate(fd, max(size, 1))
+    finally:
+        os.close(fd)
+    for array, (shape, dtype, offset) in zip(arrays, layout):
+        if array.size:
+            np.memmap(path, dtype, "r+", offset, shape)[...] = array
+    return path, layout
+
+
+def read_arrays(path, layout):
+    # Maps the arrays without copying them, the mappings stay valid after the
+    # file is removed
+    return [np.memmap(path, dtype, "r", offset, shape) if np.prod(shape) else np.zeros(shape, dtype)
+            for shape, dtype, offset in layout]
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_authkey(address, create=False):
+    # The configured key, or the one the worker created next to its socket
+    if config.inference_authkey:
+        return config.inference_authkey.encode()
+    path = address + ".key"
+    if create:
+        if os.path.exists(path):
+            os.remove(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(os.urandom(32).hex().encode())
+    with open(path, "rb") as file:
+        return file.read()
+
+
+class InferenceClient:
+    # Calls the inference worker over its Unix socket, one connection per thread
+
+    def __init__(self, address, retry_interval=5):
+        self.address = address
+        self.retry_interval = retry_interval
+        self.retry_at = 0
+        self.local = threading.local()
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if time.monotonic() < self.retry_at:
+                raise WorkerUnavailable(self.address)
+            try:
+                connection = Client(self.address, family="AF_UNIX", authkey=get_authkey(self.address))
+            except (OSError, AuthenticationError) as e:
+                self.retry_at = time.monotonic() + self.retry_interval
+                raise WorkerUnavailable(self.address) from e
+            self.local.connection = connection
+        return connection
+
+    def disconnect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def wait(self, timeout):
+        # Blocks until the worker accepts connections, it may still be starting
+        deadline = time.monotonic() + timeout
+        while True:
+            self.retry_at = 0
+            try:
+                return self.connect()
+            except WorkerUnavailable:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def call(self, method, *args, arrays=()):
+        # Returns the value and the output arrays of method on the worker
+        connection = self.connect()
+        inputs = write_arrays(arrays) if arrays else None
+        try:
+            connection.send((method, args, inputs))
+            status, value, outputs = connection.recv()
+        except (OSError, EOFError) as e:
+            self.disconnect()
+            self.retry_at = time.monotonic() + self.retry_interval
+            raise WorkerUnavailable(self.address) from e
+        finally:
+            if inputs is not None:
+                remove(inputs[0])
+        if status == "error":
+            raise RuntimeError("Inference worker failed: %s" % value)
+        if outputs is None:
+            return value, []
+        path, layout = outputs
+        try:
+            return value, read_arrays(path, layout)
+        finally:
+            remove(path)
+
+
+client = InferenceClient(config.inference_socket, config.inference_retry_interval) \
+    if config.inference_socket else None
+
+
+def call(method, *args, arrays=()):
+    # Raises WorkerUnavailable when the work should run in this process
+    if client is None:
+        raise WorkerUnavailable(None)
+    try:
+        return client.call(method, *args, arrays=arrays)
+    except WorkerUnavailable:
+        if not config.inference_fallback:
+            raise RuntimeError("Inference worker at %s is unreachable" % client.address)
+        raise
+
+
+def get_image_array(img):
+    return np.asarray(img.convert('RGB'))
+
+
+def make_output(img, heatmap):
+    # Same as gradcam.make_gradcam_output, without importing TensorFlow
+    return Image.fromarray(render_overlay(img, heatmap))
+
+
+def make_table(records):
+    # pandas is only imported once a table is built, not with the app
+    import pandas as pd
+
+    return pd.DataFrame(records)
+
+
+def explain(img, selected_class=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Predictions table and CAM overlay, see gradcam.explain
+    img = img.convert('RGB')
+    try:
+        (records, layer), (heatmap,) = call("explanation", model_name, selected_class, layer_index, method,
+                                            arrays=[get_image_array(img)])
+    except WorkerUnavailable:
+        from gradcam import explain
+        return explain(img, selected_class, layer_index, model_name, method)
+    with timed("render", layer, img):
+        img = make_output(img, heatmap)
+    return make_table(records), img
+
+
+def explain_tiled(img, selected_class=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Aggregated predictions of the tiles and full resolution overlay, see
+    # tiling.explain_tiled
+    img = img.convert('RGB')
+    try:
+        (records, layer), (heatmap,) = call("tiled", model_name, selected_class, layer_index, method,
+                                            arrays=[get_image_array(img)])
+    except WorkerUnavailable:
+        from tiling import explain_tiled
+        return explain_tiled(img, selected_class, layer_index, model_name, method)
+    img = resize_img(img, config.tiled_render_width)
+    with timed("render", layer, img):
+        img = make_output(img, downsample_heatmap(heatmap, img.size))
+    return make_table(records), img
+
+
+def extract_predictions(img, model_name=None):
+    try:
+        records, _ = call("predictions", model_name, arrays=[get_image_array(img)])
+    except WorkerUnavailable:
+        from gradcam import extract_predictions
+        return extract_predictions(img, model_name)
+    return make_table(records)
+
+
+def occlusion(img, selected_class=None, patch_size=16, stride=16, fill=0, model_name=None):
+    img = img.convert('RGB')
+    try:
+        _, (heatmap,) = call("occlusion", model_name, selected_class, patch_size, stride, fill,
+                             arrays=[get_image_array(img)])
+    except WorkerUnavailable:
+        from occlusion import occlusion
+        return occlusion(img, selected_class, patch_size, stride, fill, model_name)
+    return make_output(img, heatmap)
+
+
+def get_layer_labels(model_name=None):
+    try:
+        return call("layer_labels", model_name)[0]
+    except WorkerUnavailable:
+        from gradcam import get_layer_labels
+        return get_layer_labels(model_name)
+
+
+def warm_up(model_name=None):
+    if client is not None:
+        try:
+            client.wait(config.inference_startup_timeout)
+            return call("warm_up", model_name)[0]
+        except WorkerUnavailable:
+            if not config.inference_fallback:
+                raise
+    from gradcam import warm_up
+    warm_up(model_name)
+
+
+def get_local_stats():
+    from cache import explanation_cache
+    from models import models
+
+    # The scheduler only exists once gradcam and TensorFlow are loaded
+    gradcam = sys.modules.get("gradcam")
+    return {
+        "cache": explanation_cache.stats(),
+        "models": models.stats(),
+        "scheduler": gradcam.scheduler.stats() if gradcam is not None else None,
+    }
+
+
+def get_stats():
+    # Statistics of the process running the models
+    try:
+        return call("stats")[0]
+    except (WorkerUnavailable, RuntimeError):
+        return get_local_stats()
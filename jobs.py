@@ -0,0 +1,224 @@
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import config
+import inference
+from perturbation import apply_shapes
+from render import resize_img
+from storage import SqliteConnections, write_atomic
+
+# Long-running explanations run as jobs in background threads of the web
+# worker that submits them, without a broker. Their status lives in an sqlite
+# table and their results in a directory per job, both shared by all web
+# workers on the host. A job is identified by the hash of its inputs, so
+# submitting the same work while it is queued, running or done does not start
+# it again. Jobs use the models of the web worker, or the inference worker if
+# one is configured (see inference.py), so they hold no model copies of
+# their own.
+
+statuses = ("queued", "running", "done", "failed")
+
+
+def get_job_key(kind, *params):
+    key = hashlib.blake2b(digest_size=20)
+    key.update(kind.encode())
+    for param in params:
+        key.update(param if isinstance(param, bytes) else json.dumps(param, sort_keys=True).encode())
+    return key.hexdigest()
+
+
+class JobStore:
+
+    def __init__(self, directory, ttl, timeout):
+        self.directory = directory
+        self.ttl = ttl
+        # A job that has not reported for this long is assumed to be lost
+        # with its process and may be submitted again
+        self.timeout = timeout
+        self.connections = SqliteConnections(os.path.join(directory, "jobs.sqlite"), [
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, progress REAL NOT NULL, "
+            "message TEXT, created REAL NOT NULL, updated REAL NOT NULL)",
+        ])
+
+    def connect(self):
+        return self.connections.get()
+
+    def get_path(self, key, name=None):
+        path = os.path.join(self.directory, key)
+        return os.path.join(path, name) if name else path
+
+    def is_stale(self, job, now=None):
+        # Queued or running without reporting for longer than the timeout
+        now = time.time() if now is None else now
+        return job["status"] in ("queued", "running") and now - job["updated"] >= self.timeout
+
+    def claim(self, key, kind):
+        # True if the caller should run the job, False if it is already
+        # queued, running or done
+        connection = self.connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT status, updated FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                job = {"status": row[0], "updated": row[1]}
+                if job["status"] in ("queued", "running") and not self.is_stale(job, now):
+                    return False
+                if job["status"] == "done" and now - job["updated"] < self.ttl:
+                    return False
+            connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, 'queued', 0, NULL, ?, ?)",
+                               (key, kind, now, now))
+        finally:
+            connection.execute("COMMIT")
+        shutil.rmtree(self.get_path(key), ignore_errors=True)
+        os.makedirs(self.get_path(key))
+        return True
+
+    def update(self, key, status, progress=None, message=None):
+        self.connect().execute(
+            "UPDATE jobs SET status = ?, progress = COALESCE(?, progress), message = ?, updated = ? "
+            "WHERE key = ?", (status, progress, message, time.time(), key))
+
+    def write(self, key, name, data):
+        write_atomic(self.get_path(key, name), lambda file: file.write(data))
+
+    def read(self, key, name):
+        try:
+            with open(self.get_path(key, name), "rb") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def get(self, key):
+        row = self.connect().execute(
+            "SELECT kind, status, progress, message, updated FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        kind, status, progress, message, updated = row
+        return {"key": key, "kind": kind, "status": status, "progress": progress, "message": message,
+                "updated": updated}
+
+    def expire(self):
+        connection = self.connect()
+        keys = [key for key, in connection.execute(
+            "SELECT key FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+            (time.time() - self.ttl,))]
+        for key in keys:
+            connection.execute("DELETE FROM jobs WHERE key = ?", (key,))
+            shutil.rmtree(self.get_path(key), ignore_errors=True)
+
+    def stats(self):
+        rows = self.connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict({status: 0 for status in statuses}, **dict(rows))
+
+
+job_store = JobStore(config.job_directory, config.job_ttl, config.job_timeout)
+
+pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+    # Threads do not survive a fork, every web worker starts its own pool
+    global pool, pool_pid
+    with pool_lock:
+        if pool_pid != os.getpid():
+            pool = ThreadPoolExecutor(config.job_workers, thread_name_prefix="job")
+            pool_pid = os.getpid()
+        return pool
+
+
+def finish(key, future):
+    # run_job reports the errors of the job function, this catches the rest
+    error = future.exception()
+    if error is not None:
+        job_store.update(key, "failed", message="%s: %s" % (type(error).__name__, error))
+
+
+def submit(kind, key, function, *args):
+    # Runs function(report, *args) in the pool unless the same job exists
+    job_store.expire()
+    if job_store.claim(key, kind):
+        future = get_pool().submit(run_job, function, key, *args)
+        future.add_done_callback(lambda future: finish(key, future))
+    return key
+
+
+class Reporter:
+    # Passed to the job function to publish progress and partial results
+
+    def __init__(self, key):
+        self.key = key
+
+    def __call__(self, progress, message, name=None, img=None, table=None):
+        if img is not None:
+            buffered = io.BytesIO()
+            img.save(buffered, format=config.render_format)
+            job_store.write(self.key, "%s.%s" % (name, config.render_format.lower()), buffered.getvalue())
+        if table is not None:
+            job_store.write(self.key, name + ".json", json.dumps(table).encode())
+        job_store.update(self.key, "running", progress, message)
+
+
+def run_job(function, key, *args):
+    job_store.update(key, "running", 0, "started")
+    try:
+        function(Reporter(key), *args)
+    except Exception as e:
+        job_store.update(key, "failed", message="%s: %s" % (type(e).__name__, e))
+        return
+    job_store.update(key, "done", 1, "done")
+
+
+def get_result(key, name):
+    # Path of a result image for the /jobs route and its table, if written
+    table = job_store.read(key, name + ".json")
+    path = "/jobs/%s/%s.%s" % (key, name, config.render_format.lower())
+    if not os.path.exists(job_store.get_path(key, "%s.%s" % (name, config.render_format.lower()))):
+        path = None
+    return path, json.loads(table) if table is not None else None
+
+
+def load_image(source, shapes):
+    # The image is passed as encoded bytes when it is large, the shapes are
+    # then burned in by the job instead of the callback
+    if isinstance(source, bytes):
+        return apply_shapes(Image.open(io.BytesIO(source)).convert('RGB'), shapes)
+    return source
+
+
+def run_explanation(report, source, shapes, selected_class, layer_index, model_name, method, tiled):
+    # A coarse Grad-CAM of the downscaled image first, then the slow method
+    # or the tiled explanation
+    img = load_image(source, shapes)
+    report(0.05, "computing a coarse Grad-CAM")
+    df, overlay = inference.explain(resize_img(img, 600), selected_class, layer_index, model_name)
+    report(0.2, "refining", "coarse", overlay, df.to_dict('records'))
+    if tiled:
+        df, overlay = inference.explain_tiled(img, selected_class, layer_index, model_name, method)
+    else:
+        df, overlay = inference.explain(img, selected_class, layer_index, model_name, method)
+    report(1, "done", "result", overlay, df.to_dict('records'))
+
+
+def run_occlusion(report, img, selected_class, patch_size, model_name):
+    # A sweep with large patches first, which needs a fraction of the
+    # forward passes
+    coarse_size = 56
+    if patch_size < coarse_size:
+        report(0.05, "sweeping %d px patches" % coarse_size)
+        report(0.2, "refining", "coarse",
+               inference.occlusion(img, selected_class, coarse_size, coarse_size, model_name=model_name))
+    report(0.25, "sweeping %d px patches" % patch_size)
+    report(1, "done", "result",
+           inference.occlusion(img, selected_class, patch_size, patch_size, model_name=model_name))
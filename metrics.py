@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+import resource
+import threading
+import functools
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import config
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Input sizes are labeled by their longest side rounded up to these values
+size_buckets = (224, 600, 1024, 2048, 4096)
+
+
+class Histogram:
+    # A Prometheus histogram with one series per combination of label values
+
+    def __init__(self, name, help, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                labels = list(zip(self.label_names, key))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("%s_bucket%s %d" % (self.name, format_labels(labels + [("le", bound)]),
+                                                     bucket_count))
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(labels + [("le", "+Inf")]), count))
+                lines.append("%s_sum%s %r" % (self.name, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (self.name, format_labels(labels), count))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def format_metric(name, type, help, samples):
+    # samples is a list of (labels, value) pairs
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, type)]
+    for labels, value in samples:
+        lines.append("%s%s %r" % (name, format_labels(sorted(labels.items())), value))
+    return lines
+
+
+histograms = OrderedDict()
+collectors = []
+
+
+def register_histogram(histogram):
+    histograms[histogram.name] = histogram
+    return histogram
+
+
+def register_collector(collect):
+    # collect returns a list of (name, type, help, samples) tuples
+    collectors.append(collect)
+    return collect
+
+
+stage_latency = register_histogram(Histogram(
+    "gradcam_stage_seconds", "Latency of the explanation pipeline stages.",
+    ("stage", "layer", "input_size")))
+callback_latency = register_histogram(Histogram(
+    "gradcam_callback_seconds", "Latency of the Dash callbacks.", ("callback",)))
+
+
+def get_size_label(size):
+    longest = max(size)
+    for bound in size_buckets:
+        if longest <= bound:
+            return "<=%d" % bound
+    return ">%d" % size_buckets[-1]
+
+
+def get_input_size(value):
+    size = getattr(value, "size", None)
+    if isinstance(size, tuple) and len(size) == 2:
+        return get_size_label(size)
+    return ""
+
+
+@contextmanager
+def timed(stage, layer="", img=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe(time.perf_counter() - start, stage=stage, layer=layer,
+                              input_size=get_input_size(img))
+
+
+def instrument(stage):
+    # Times a function, labeled with the size of its first argument or result
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            input_size = get_input_size(args[0]) if args else ""
+            stage_latency.observe(time.perf_counter() - start, stage=stage,
+                                  input_size=input_size or get_input_size(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def get_stack(frame):
+    # A stack in the collapsed format of flamegraph.pl, outermost frame first
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+@contextmanager
+def profile_if_slow(name):
+    # Samples the stacks of the current thread and dumps them if the block
+    # takes longer than the configured threshold
+    if not config.profile_slow_requests:
+        yield
+        return
+
+    samples = Counter()
+    thread_id = threading.get_ident()
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(config.profile_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[get_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        sampler.join()
+        elapsed = time.perf_counter() - start
+        if elapsed >= config.profile_threshold and samples:
+            os.makedirs(config.profile_directory, exist_ok=True)
+            path = os.path.join(config.profile_directory, "%s-%d-%dms.folded"
+                                % (name, int(time.time() * 1000), int(elapsed * 1000)))
+            with open(path, "w") as file:
+                for stack, count in samples.most_common():
+                    file.write("%s %d\n" % (stack, count))
+
+
+def instrument_callback(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with profile_if_slow(name):
+                    return function(*args, **kwargs)
+            finally:
+                callback_latency.observe(time.perf_counter() - start, callback=name)
+        return wrapper
+    return decorator
+
+
+def get_resident_memory():
+    # Current resident set size in bytes, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def get_os_threads():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def collect_process():
+    metrics = [
+        ("process_peak_resident_memory_bytes", "gauge", "Peak resident set size.",
+         [({}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)]),
+        ("process_python_threads", "gauge", "Python threads.", [({}, threading.active_count())]),
+    ]
+    resident_memory = get_resident_memory()
+    if resident_memory is not None:
+        metrics.append(("process_resident_memory_bytes", "gauge", "Resident set size.",
+                        [({}, resident_memory)]))
+    os_threads = get_os_threads()
+    if os_threads is not None:
+        metrics.append(("process_os_threads", "gauge",
+                        "Operating system threads, including the TensorFlow pools.", [({}, os_threads)]))
+
+    # Only report the TensorFlow settings once it has been imported by a request
+    tf = sys.modules.get("tensorflow")
+    if tf is not None:
+        metrics.append(("tensorflow_thread_pool_size", "gauge",
+                        "Configured TensorFlow thread pools, 0 means chosen by TensorFlow.",
+                        [({"pool": "inter_op"}, tf.config.threading.get_inter_op_parallelism_threads()),
+                         ({"pool": "intra_op"}, tf.config.threading.get_intra_op_parallelism_threads())]))
+    return metrics
+
+
+register_collector(collect_process)
+
+
+def render():
+    lines = []
+    for histogram in histograms.values():
+        lines.extend(histogram.render())
+    for collect in collectors:
+        for name, type, help, samples in collect():
+            lines.extend(format_metric(name, type, help, samples))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,237 @@
+import os
+import re
+import gc
+import threading
+from collections import OrderedDict, namedtuple
+
+import config
+
+# An architecture from keras.applications. block_pattern matches the names of
+# the layers that start a block; the last layer with a spatial output of every
+# block becomes a candidate Grad-CAM layer. layer_names, layer_labels and
+# blocks can be given instead of deriving them from the loaded model.
+ModelSpec = namedtuple("ModelSpec", ["name", "label", "module", "img_size", "block_pattern",
+                                     "layer_names", "layer_labels", "blocks"])
+
+
+def make_spec(name, label, module, img_size=(224, 224), block_pattern=None,
+              layer_names=None, layer_labels=None, blocks=None):
+    return ModelSpec(name, label, module, img_size, block_pattern and re.compile(block_pattern),
+                     layer_names, layer_labels, blocks)
+
+
+efficientnet_blocks = r"^(stem|top|block\d+[a-z])(?=_)"
+
+registry = OrderedDict((spec.name, spec) for spec in [
+    make_spec("EfficientNetB0", "EfficientNet B0", "efficientnet", (224, 224), efficientnet_blocks,
+              layer_names=["stem_activation",
+                           "block1a_project_bn",
+                           "block2a_project_bn",
+                           "block2b_add",
+                           "block3a_project_bn",
+                           "block3b_add",
+                           "block4a_project_bn",
+                           "block4b_add",
+                           "block4c_add",
+                           "block5a_project_bn",
+                           "block5b_add",
+                           "block5c_add",
+                           "block6a_project_bn",
+                           "block6b_add",
+                           "block6c_add",
+                           "block6d_add",
+                           "block7a_project_bn",
+                           "top_activation"],
+              layer_labels=['stem', '1a', '2a', '2b', '3a', '3b', '4a', '4b', '4c', '5a', '5b', '5c',
+                            '6a', '6b', '6c', '6d', '7a', 'top'],
+              blocks=["Conv3x3", "MBConv1, 3x3", "MBConv6, 3x3", "MBConv6, 3x3", "MBConv6, 5x5",
+                      "MBConv6, 5x5", "MBConv6, 3x3", "MBConv6, 3x3", "MBConv6, 3x3", "MBConv6, 5x5",
+                      "MBConv6, 5x5", "MBConv6, 5x5", "MBConv6, 5x5", "MBConv6, 5x5", "MBConv6, 5x5",
+                      "MBConv6, 5x5", "MBConv6, 3x3", "Conv1x1"]),
+    make_spec("EfficientNetB1", "EfficientNet B1", "efficientnet", (240, 240), efficientnet_blocks),
+    make_spec("EfficientNetB2", "EfficientNet B2", "efficientnet", (260, 260), efficientnet_blocks),
+    make_spec("EfficientNetB3", "EfficientNet B3", "efficientnet", (300, 300), efficientnet_blocks),
+    make_spec("ResNet50", "ResNet50", "resnet50", (224, 224), r"^(conv1|conv\d+_block\d+)(?=_)"),
+    make_spec("MobileNetV2", "MobileNet V2", "mobilenet_v2", (224, 224),
+              r"^(Conv1|expanded_conv|block_\d+|Conv_1|out)(?=_|$)"),
+    make_spec("MobileNetV3Small", "MobileNet V3 Small", "mobilenet_v3", (224, 224),
+              r"^(Conv(_1)?|expanded_conv(_\d+)?)(?=[/_]|$)"),
+    make_spec("MobileNetV3Large", "MobileNet V3 Large", "mobilenet_v3", (224, 224),
+              r"^(Conv(_1)?|expanded_conv(_\d+)?)(?=[/_]|$)"),
+    make_spec("ConvNeXtTiny", "ConvNeXt Tiny", "convnext", (224, 224),
+              r"^convnext_[a-z]+_(stem|downsampling_block_\d+|stage_\d+_block_\d+)(?=_|$)"),
+])
+
+
+class LazyModel:
+    # Holds a model that is only loaded on first use. Loading is thread safe,
+    # concurrent callers wait for the same load.
+
+    def __init__(self, load):
+        self.load = load
+        self.lock = threading.Lock()
+        self.value = None
+
+    @property
+    def loaded(self):
+        return self.value is not None
+
+    def get(self):
+        if self.value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value = self.load()
+        return self.value
+
+
+def get_spec(name=None):
+    name = name or config.default_model
+    if name not in registry:
+        raise ValueError("Unknown model %r, expected one of %s" % (name, list(registry)))
+    return registry[name]
+
+
+def get_application_module(spec):
+    from tensorflow import keras
+
+    return getattr(keras.applications, spec.module)
+
+
+def load_keras_model(spec):
+    from tensorflow import keras
+
+    if spec.name == config.default_model and config.model_path:
+        # A SavedModel directory or a serialized Keras model
+        return keras.models.load_model(config.model_path, compile=False)
+    # Local weights avoid downloading the imagenet weights on first start
+    weights = config.weights_path if spec.name == config.default_model else None
+    if not weights and config.weights_directory:
+        path = os.path.join(config.weights_directory, spec.name + ".h5")
+        weights = path if os.path.exists(path) else None
+    builder = getattr(keras.applications, spec.name)
+    return builder(weights=weights or "imagenet", input_shape=spec.img_size + (3,))
+
+
+def get_output_shape(layer):
+    try:
+        return tuple(layer.output.shape)
+    except (AttributeError, ValueError):
+        # layers used at several places of the graph have no single output
+        return None
+
+
+def derive_layers(model, block_pattern):
+    # The last layer with a spatial output of every block. Layers that do not
+    # start a block (batch norms, activations, unnamed operations) belong to
+    # the block before them.
+    layer_names = []
+    layer_labels = []
+    block = None
+    for layer in model.layers:
+        match = block_pattern.match(layer.name)
+        if match:
+            name = match.group(1)
+            if name != block:
+                block = name
+                layer_names.append(None)
+                layer_labels.append(name)
+        if block is None:
+            continue
+        shape = get_output_shape(layer)
+        if shape is not None and len(shape) == 4 and (shape[1] or 2) > 1 and (shape[2] or 2) > 1:
+            layer_names[-1] = layer.name
+
+    return ([name for name in layer_names if name is not None],
+            [label for name, label in zip(layer_names, layer_labels) if name is not None])
+
+
+class LoadedModel:
+    # A resident model together with everything derived from it
+
+    def __init__(self, spec):
+        from tensorflow import keras
+
+        self.spec = spec
+        self.name = spec.name
+        self.img_size = spec.img_size
+        self.model = load_keras_model(spec)
+        if spec.layer_names:
+            self.layer_names, self.layer_labels = list(spec.layer_names), list(spec.layer_labels)
+        else:
+            self.layer_names, self.layer_labels = derive_layers(self.model, spec.block_pattern)
+
+        # A single model mapping the input image to the activations of every
+        # layer in layer_names as well as the output predictions. It is built
+        # once so a single forward/backward pass yields the heatmaps for all
+        # layers.
+        self.grad_model = keras.models.Model(
+            [self.model.inputs],
+            [self.model.get_layer(layer_name).output for layer_name in self.layer_names]
+            + [self.model.output]
+        )
+        # Traced kernels and the prediction backend, see gradcam.py
+        self.kernels = {}
+        self.prediction_backend = None
+        # float32 weights plus the same again for the traced graphs
+        self.size = 2 * 4 * self.model.count_params()
+
+
+class ModelCache:
+    # Loads models on demand and keeps the least recently used ones resident
+    # as long as their estimated size fits into max_bytes
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, name=None):
+        spec = get_spec(name)
+        with self.lock:
+            loaded = self.models.get(spec.name)
+            if loaded is not None:
+                self.models.move_to_end(spec.name)
+                return loaded
+            # Concurrent callers wait for the same load
+            holder = self.loading.setdefault(spec.name, LazyModel(lambda: LoadedModel(spec)))
+
+        loaded = holder.get()
+        with self.lock:
+            if self.loading.get(spec.name) is holder:
+                del self.loading[spec.name]
+                self.models[spec.name] = loaded
+                self.loads += 1
+                self.evict(keep=spec.name)
+        return loaded
+
+    def evict(self, keep):
+        evicted = False
+        while sum(loaded.size for loaded in self.models.values()) > self.max_bytes and len(self.models) > 1:
+            name = next(iter(self.models))
+            if name == keep:
+                self.models.move_to_end(name)
+                name = next(iter(self.models))
+            del self.models[name]
+            self.evictions += 1
+            evicted = True
+        if evicted:
+            gc.collect()
+
+    def is_loaded(self, name=None):
+        return get_spec(name).name in self.models
+
+    def stats(self):
+        with self.lock:
+            return {
+                "resident": list(self.models),
+                "bytes": sum(loaded.size for loaded in self.models.values()),
+                "max_bytes": self.max_bytes,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+models = ModelCache(config.max_model_bytes)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from cache import explanation_cache, image_key
+from gradcam import (get_img_array, get_model_name, get_prediction_backend, get_selected_index,
+                     make_gradcam_output, preprocess_input)
+
+
+def get_patch_positions(size, patch_size, stride):
+    # A patch larger than the image covers all of it
+    patch_size = min(patch_size, size)
+    positions = list(range(0, size - patch_size + 1, stride))
+    # Make sure the last patch reaches the border
+    if positions[-1] + patch_size < size:
+        positions.append(size - patch_size)
+    return np.array(positions)
+
+
+def make_occlusion_masks(rows, columns, patch_size, shape):
+    # Boolean masks of shape (n, height, width), one per (row, column) pair
+    ys = np.arange(shape[0])
+    xs = np.arange(shape[1])
+    row_masks = (ys >= rows[:, np.newaxis]) & (ys < rows[:, np.newaxis] + patch_size)
+    column_masks = (xs >= columns[:, np.newaxis]) & (xs < columns[:, np.newaxis] + patch_size)
+    return row_masks[:, :, np.newaxis] & column_masks[:, np.newaxis, :]
+
+
+def get_fill_value(img_array, fill):
+    if fill == "mean":
+        return img_array.mean(axis=(0, 1))
+    return np.full(3, fill, dtype=np.float32)
+
+
+def occlusion_sensitivity(img, selected_class=None, patch_size=16, stride=16, fill=0, batch_size=98,
+                          model_name=None):
+    # Confidence drop of the selected class when each patch of the model input
+    # is replaced by fill (a pixel value or "mean"). Returns an array with one
+    # value per patch position and the index of the explained class.
+    img_array = get_img_array(img.convert('RGB'), model_name)
+    # The fill is a pixel value, it goes through the preprocessing of the
+    # model like the image, so fill=0 is a black patch for every model
+    fill_pixel = get_fill_value(img_array[0], fill).astype(np.float32).reshape(1, 1, 1, 3)
+    fill_value = preprocess_input(fill_pixel, model_name)[0, 0, 0]
+    img_array = preprocess_input(img_array, model_name)[0]
+    height, width = img_array.shape[:2]
+
+    backend = get_prediction_backend(model_name)
+    preds = backend.predict(img_array[np.newaxis])[0]
+    rank = get_selected_index(selected_class) or 0
+    class_index = np.argsort(preds)[::-1][rank]
+
+    rows = get_patch_positions(height, patch_size, stride)
+    columns = get_patch_positions(width, patch_size, stride)
+    grid_rows, grid_columns = [grid.ravel() for grid in np.meshgrid(rows, columns, indexing="ij")]
+
+    scores = np.empty(len(grid_rows), dtype=np.float32)
+    for start in range(0, len(grid_rows), batch_size):
+        end = min(start + batch_size, len(grid_rows))
+        masks = make_occlusion_masks(grid_rows[start:end], grid_columns[start:end],
+                                     patch_size, (height, width))
+        img_batch = np.where(masks[..., np.newaxis], fill_value, img_array)
+        scores[start:end] = backend.predict(img_batch)[:, class_index]
+
+    sensitivity = preds[class_index] - scores
+    return sensitivity.reshape(len(rows), len(columns)), class_index
+
+
+def occlusion_heatmap(img, selected_class=None, patch_size=16, stride=16, fill=0, model_name=None):
+    # The confidence drops scaled to 0-1 like a Grad-CAM heatmap
+    img = img.convert('RGB')
+    model_name = get_model_name(model_name)
+    params = ("occlusion", get_selected_index(selected_class), patch_size, stride, fill, model_name)
+    sensitivity, = explanation_cache.get_or_compute(
+        image_key(img, *params),
+        lambda: [occlusion_sensitivity(img, selected_class, patch_size, stride, fill,
+                                       model_name=model_name)[0]])
+
+    heatmap = np.maximum(sensitivity, 0)
+    if heatmap.max() > 0:
+        heatmap = heatmap / heatmap.max()
+    return heatmap
+
+
+def occlusion(img, selected_class=None, patch_size=16, stride=16, fill=0, model_name=None):
+    # The confidence drops rendered like a Grad-CAM heatmap
+    img = img.convert('RGB')
+    return make_gradcam_output(img, occlusion_heatmap(img, selected_class, patch_size, stride, fill, model_name))
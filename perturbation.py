@@ -0,0 +1,147 @@
+import re
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+from metrics import instrument
+from utils import img_width, img_height, scale_factor
+
+# Style plotly uses for newly drawn shapes, see make_img_graph
+default_fill_color = "black"
+default_line_width = 4
+
+path_token = re.compile(r"[MmLlHhVvZzCcSsQqTtAa]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+path_arg_count = {"M": 2, "L": 2, "H": 1, "V": 1, "Z": 0, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7}
+shape_edit = re.compile(r"^shapes\[(\d+)\]\.(\w+)$")
+
+
+def update_shapes(shapes, relayout_data=None):
+    # Applies the changes of a relayout event to the list of drawn shapes
+    relayout_data = relayout_data or {}
+    if "shapes" in relayout_data:
+        shapes = relayout_data["shapes"]
+    shapes = [dict(shape) for shape in shapes]
+
+    # Moving or resizing a shape only sends the changed attributes
+    for key, value in relayout_data.items():
+        match = shape_edit.match(key)
+        if match and int(match.group(1)) < len(shapes):
+            shapes[int(match.group(1))][match.group(2)] = value
+    return shapes
+
+
+def to_pixels(x, y, size):
+    # Inverse of the axis mapping in make_img_graph: the image is stretched
+    # over the whole graph and the y axis points upwards
+    width, height = size
+    px = float(x) * width / (img_width * scale_factor)
+    py = (img_height * scale_factor - float(y)) * height / (img_height * scale_factor)
+    return px, py
+
+
+def parse_path(path):
+    # Returns the sub paths of an SVG path as lists of absolute points. Curves
+    # and arcs are approximated by their end points, which is what plotly's
+    # closed path drawing produces anyway.
+    polygons = []
+    points = []
+    x = y = start_x = start_y = 0.0
+    command = None
+    tokens = path_token.findall(path)
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            command = tokens[i]
+            i += 1
+        elif command is None:
+            raise ValueError("Invalid SVG path: %r" % path)
+
+        upper = command.upper()
+        relative = command.islower()
+        if upper == "Z":
+            if points:
+                polygons.append(points)
+            points = []
+            x, y = start_x, start_y
+            command = None
+            continue
+
+        count = path_arg_count[upper]
+        args = [float(value) for value in tokens[i:i + count]]
+        if len(args) < count:
+            raise ValueError("Invalid SVG path: %r" % path)
+        i += count
+
+        if upper == "H":
+            x = args[0] + (x if relative else 0)
+        elif upper == "V":
+            y = args[0] + (y if relative else 0)
+        else:
+            x = args[-2] + (x if relative else 0)
+            y = args[-1] + (y if relative else 0)
+
+        if upper == "M":
+            if points:
+                polygons.append(points)
+            points = []
+            start_x, start_y = x, y
+            # further coordinate pairs after a move are line segments
+            command = "l" if relative else "L"
+        points.append((x, y))
+
+    if points:
+        polygons.append(points)
+    return polygons
+
+
+def shape_to_polygons(shape, size):
+    if shape.get("type") == "rect":
+        x0, y0 = to_pixels(shape["x0"], shape["y0"], size)
+        x1, y1 = to_pixels(shape["x1"], shape["y1"], size)
+        return [[(x0, y0), (x1, y0), (x1, y1), (x0, y1)]]
+    if shape.get("type") == "path":
+        return [[to_pixels(x, y, size) for x, y in polygon]
+                for polygon in parse_path(shape["path"])]
+    return []
+
+
+def get_color(color):
+    try:
+        return ImageColor.getrgb(color)[:3]
+    except (ValueError, AttributeError):
+        return ImageColor.getrgb(default_fill_color)
+
+
+@instrument("apply_shapes")
+def apply_shapes(img, shapes):
+    img = img.convert("RGB")
+    if not shapes:
+        return img
+
+    img_array = np.array(img)
+    # Line widths are given in screen pixels of the scaled graph
+    line_scale = img.size[0] / (img_width * scale_factor)
+    for shape in shapes:
+        polygons = [polygon for polygon in shape_to_polygons(shape, img.size) if len(polygon) > 1]
+        if not polygons:
+            continue
+
+        line = shape.get("line") or {}
+        line_width = line.get("width", default_line_width)
+        line_width = int(round(line_width * line_scale))
+
+        mask = Image.new("L", img.size, 0)
+        draw = ImageDraw.Draw(mask)
+        for polygon in polygons:
+            draw.polygon(polygon, fill=255)
+            if line_width > 0:
+                draw.line(polygon + polygon[:1], fill=255, width=line_width)
+
+        opacity = float(shape.get("opacity", 1))
+        color = np.array(get_color(shape.get("fillcolor", default_fill_color)), dtype=np.float32)
+        weights = np.asarray(mask, dtype=np.float32)[..., np.newaxis] * (opacity / 255)
+        region = weights[..., 0] > 0
+        img_array[region] = np.round(
+            img_array[region] * (1 - weights[region]) + color * weights[region]).astype(np.uint8)
+
+    return Image.fromarray(img_array)
@@ -0,0 +1,177 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from metrics import instrument
+
+# uint8 lookup tables of the colormaps used so far
+colormaps = {}
+# Interpolation matrices keyed by input size, output size and method, the
+# least recently used are dropped. Every new image size adds two of them.
+interpolation_matrices = OrderedDict()
+max_interpolation_matrices = 32
+interpolation_lock = threading.Lock()
+interpolation_methods = ("nearest", "bilinear", "bicubic")
+
+# Output buffers are reused across calls of the same thread
+buffers = threading.local()
+
+
+@instrument("resize_img")
+def resize_img(img, max_width=800):
+    width, height = img.size
+    if width > max_width:
+        ratio = width / height
+        new_width = max_width
+        new_height = int(new_width / ratio)
+        img = img.resize((new_width, new_height))
+    return img
+
+
+def get_matplotlib_colormap(name):
+    # matplotlib is only needed to build a table once
+    try:
+        from matplotlib import colormaps as matplotlib_colormaps
+    except ImportError:
+        # matplotlib < 3.5
+        from matplotlib import cm
+        return cm.get_cmap(name)
+    return matplotlib_colormaps[name]
+
+
+def get_colormap(name="jet"):
+    lut = colormaps.get(name)
+    if lut is None:
+        colormap = get_matplotlib_colormap(name)
+        lut = np.round(colormap(np.arange(256))[:, :3] * 255).astype(np.uint8)
+        colormaps[name] = lut
+    return lut
+
+
+def get_buffer(name, shape, dtype):
+    arrays = buffers.__dict__.setdefault("arrays", {})
+    array = arrays.get(name)
+    if array is None or array.shape != shape or array.dtype != dtype:
+        array = np.empty(shape, dtype=dtype)
+        arrays[name] = array
+    return array
+
+
+def cubic(x, a=-0.5):
+    # Keys' cubic convolution kernel, as used by PIL's bicubic filter
+    x = np.abs(x)
+    return np.where(x <= 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, ((x - 5) * x + 8) * x * a - 4 * a, 0))
+
+
+def get_interpolation_matrix(n_in, n_out, method):
+    # Matrix mapping n_in samples to n_out samples with aligned pixel centers
+    key = (n_in, n_out, method)
+    with interpolation_lock:
+        matrix = interpolation_matrices.get(key)
+        if matrix is not None:
+            interpolation_matrices.move_to_end(key)
+            return matrix
+
+    if method not in interpolation_methods:
+        raise ValueError("Unknown interpolation method %r, expected one of %s"
+                         % (method, interpolation_methods))
+    x = (np.arange(n_out) + 0.5) * n_in / n_out - 0.5
+    rows = np.arange(n_out)
+    matrix = np.zeros((n_out, n_in), dtype=np.float32)
+    if method == "nearest":
+        matrix[rows, np.clip(np.round(x), 0, n_in - 1).astype(int)] = 1
+    elif method == "bilinear":
+        x = np.clip(x, 0, n_in - 1)
+        left = np.floor(x).astype(int)
+        right = np.minimum(left + 1, n_in - 1)
+        weight = x - left
+        np.add.at(matrix, (rows, left), 1 - weight)
+        np.add.at(matrix, (rows, right), weight)
+    else:
+        start = np.floor(x).astype(int) - 1
+        for offset in range(4):
+            index = start + offset
+            np.add.at(matrix, (rows, np.clip(index, 0, n_in - 1)), cubic(x - index))
+    with interpolation_lock:
+        interpolation_matrices[key] = matrix
+        while len(interpolation_matrices) > max_interpolation_matrices:
+            interpolation_matrices.popitem(last=False)
+    return matrix
+
+
+def upsample_heatmap(heatmap, size, method="bilinear", out=None):
+    # Resizes a small heatmap to size = (width, height) as two matrix products
+    width, height = size
+    if out is None:
+        out = np.empty((height, width), dtype=np.float32)
+    if heatmap.shape == (height, width):
+        # e.g. a tiled map already downsampled to the image
+        np.copyto(out, heatmap, casting="unsafe")
+        return out
+    rows = get_interpolation_matrix(heatmap.shape[0], height, method)
+    columns = get_interpolation_matrix(heatmap.shape[1], width, method)
+    np.matmul(rows @ heatmap.astype(np.float32), columns.T, out=out)
+    if method == "bicubic":
+        # the cubic kernel overshoots at sharp edges
+        np.clip(out, 0, 1, out=out)
+    return out
+
+
+def downsample_heatmap(heatmap, size):
+    # Area average of a heatmap larger than size = (width, height), e.g. a
+    # full resolution map rendered on a smaller preview. The interpolation
+    # matrices would get large and skip most of its pixels.
+    if heatmap.shape[1] <= size[0] and heatmap.shape[0] <= size[1]:
+        return heatmap
+    return np.asarray(Image.fromarray(np.asarray(heatmap, dtype=np.float32)).resize(size, Image.BOX))
+
+
+def render_heatmap(heatmap, size, method="bilinear", colormap=None):
+    # Only the upsampled heatmap, as uint8 intensities or colorized, so clients
+    # can do the compositing themselves
+    upsampled = upsample_heatmap(heatmap, size, method)
+    indices = np.empty(upsampled.shape, dtype=np.uint8)
+    np.copyto(indices, np.clip(upsampled * 255, 0, 255), casting="unsafe")
+    if colormap is None:
+        return indices
+    return get_colormap(colormap)[indices]
+
+
+def render_overlay(img, heatmap, alpha=0.4, colormap="jet", method="bilinear", out=None):
+    # Superimposes the colorized heatmap on img and returns an uint8 array of
+    # shape (height, width, 3). Unless out is given the array is a buffer that
+    # is overwritten by the next call in this thread.
+    img_array = np.asarray(img.convert('RGB'))
+    height, width = img_array.shape[:2]
+
+    # Rescale heatmap to a range 0-255 and colorize it
+    upsampled = upsample_heatmap(heatmap, (width, height), method,
+                                 out=get_buffer("upsampled", (height, width), np.float32))
+    np.multiply(upsampled, 255, out=upsampled)
+    np.clip(upsampled, 0, 255, out=upsampled)
+    indices = get_buffer("indices", (height, width), np.uint8)
+    np.copyto(indices, upsampled, casting="unsafe")
+    colors = get_buffer("colors", (height, width, 3), np.uint8)
+    np.take(get_colormap(colormap), indices, axis=0, out=colors)
+
+    # The baseline added alpha * heatmap to the image and rescaled the sum from
+    # its min-max range to 0-255. This is approximately the same: a blend with
+    # weight alpha / (1 + alpha) in 8 bit fixed point. The weight is rounded to
+    # 1/256 and the shift truncates, so it is within 1 level of the exact float
+    # blend. The min-max rescale only matches that blend when the sum spans
+    # 0 to 255 * (1 + alpha), otherwise the baseline also stretched contrast.
+    weight = int(round(256 * alpha / (1 + alpha)))
+    blended = get_buffer("blended", (height, width, 3), np.uint16)
+    weighted = get_buffer("weighted", (height, width, 3), np.uint16)
+    np.multiply(img_array, np.uint16(256 - weight), out=blended)
+    np.multiply(colors, np.uint16(weight), out=weighted)
+    np.add(blended, weighted, out=blended)
+    np.right_shift(blended, 8, out=blended)
+
+    if out is None:
+        out = get_buffer("overlay", (height, width, 3), np.uint8)
+    np.copyto(out, blended, casting="unsafe")
+    return out
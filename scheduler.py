@@ -0,0 +1,88 @@
+import os
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+
+class BatchScheduler:
+    # Groups requests submitted by concurrent callers into batches. A batch is
+    # started once max_batch_size requests are queued or max_wait seconds after
+    # its first request, and compute maps the list of request arguments to the
+    # list of results.
+
+    def __init__(self, compute, max_batch_size=16, max_wait=0.005):
+        self.compute = compute
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        # Threads do not survive a fork, so every worker process starts its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                threading.Thread(target=self.run, daemon=True).start()
+                self.pid = os.getpid()
+
+    def submit(self, *args):
+        self.start()
+        future = Future()
+        self.queue.put((args, future))
+        return future
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            with self.lock:
+                self.queue_depths[len(batch) + self.queue.qsize()] += 1
+                self.batch_sizes[len(batch)] += 1
+                self.requests += len(batch)
+                self.batches += 1
+
+            args = [item[0] for item in batch]
+            futures = [item[1] for item in batch]
+            try:
+                results = self.compute(args)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "errors": self.errors,
+                "queue_depth": self.queue.qsize(),
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "queue_depth_histogram": dict(sorted(self.queue_depths.items())),
+                "max_batch_size": self.max_batch_size,
+                "max_wait": self.max_wait,
+            }
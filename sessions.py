@@ -0,0 +1,177 @@
+import io
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import config
+from storage import write_atomic
+
+valid_id = re.compile(r"^[0-9a-f]{32}$")
+# File names without directories, "." and ".." or hidden temporary files
+valid_name = re.compile(r"^(?!\.)[\w.-]+$")
+
+
+class SessionStore:
+    # Keeps the uploaded image, the drawn shapes and rendered files of every
+    # user session on the server. Memory is bounded by max_bytes (least
+    # recently used sessions are dropped first) and sessions expire after ttl
+    # seconds without access. With a directory, sessions are also written to
+    # disk, so they survive eviction and are shared by all workers on a host.
+
+    def __init__(self, max_bytes, ttl, directory=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def create(self, img):
+        self.expire()
+        session_id = uuid.uuid4().hex
+        session = {"image": img.convert('RGB'), "shapes": [], "files": {}}
+        if self.directory:
+            path = self.get_path(session_id)
+            os.makedirs(os.path.join(path, "files"))
+            session["image"].save(os.path.join(path, "image.png"))
+            self.write(session_id, "shapes.json", json.dumps([]).encode())
+        self.add(session_id, session)
+        return session_id
+
+    def get(self, session_id):
+        if not session_id or not valid_id.match(session_id):
+            return None
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                if time.time() - session["accessed"] <= self.ttl:
+                    session["accessed"] = time.time()
+                    self.sessions.move_to_end(session_id)
+                    return session
+                self.remove(session_id)
+        return self.load(session_id)
+
+    def get_image(self, session_id):
+        session = self.get(session_id)
+        return session["image"] if session is not None else None
+
+    def get_shapes(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            return None
+        if self.directory:
+            # Another worker may have updated them
+            with open(os.path.join(self.get_path(session_id), "shapes.json")) as file:
+                session["shapes"] = json.load(file)
+        return session["shapes"]
+
+    def set_shapes(self, session_id, shapes):
+        session = self.get(session_id)
+        if session is not None:
+            session["shapes"] = shapes
+            if self.directory:
+                self.write(session_id, "shapes.json", json.dumps(shapes).encode())
+
+    def get_file(self, session_id, name):
+        session = self.get(session_id)
+        if session is None or not valid_name.match(name):
+            return None
+        data = session["files"].get(name)
+        if data is None and self.directory:
+            path = os.path.join(self.get_path(session_id), "files", name)
+            if os.path.exists(path):
+                with open(path, "rb") as file:
+                    data = file.read()
+                self.add_file(session_id, session, name, data)
+        return data
+
+    def put_file(self, session_id, name, data):
+        session = self.get(session_id)
+        if session is None or not valid_name.match(name):
+            return False
+        if self.directory:
+            self.write(session_id, os.path.join("files", name), data)
+        self.add_file(session_id, session, name, data)
+        return True
+
+    def add_file(self, session_id, session, name, data):
+        with self.lock:
+            if session_id in self.sessions and name not in session["files"]:
+                session["files"][name] = data
+                session["size"] += len(data)
+                self.bytes += len(data)
+                self.evict()
+
+    def get_path(self, session_id):
+        return os.path.join(self.directory, session_id)
+
+    def write(self, session_id, name, data):
+        write_atomic(os.path.join(self.get_path(session_id), name), lambda file: file.write(data))
+
+    def load(self, session_id):
+        if not self.directory:
+            return None
+        path = self.get_path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            os.utime(path)
+            with open(os.path.join(path, "image.png"), "rb") as file:
+                img = Image.open(io.BytesIO(file.read())).convert('RGB')
+            with open(os.path.join(path, "shapes.json")) as file:
+                shapes = json.load(file)
+        except OSError:
+            return None
+        session = {"image": img, "shapes": shapes, "files": {}}
+        self.add(session_id, session)
+        return session
+
+    def add(self, session_id, session):
+        img = session["image"]
+        session["size"] = img.size[0] * img.size[1] * len(img.getbands())
+        session["size"] += sum(len(data) for data in session["files"].values())
+        session["accessed"] = time.time()
+        with self.lock:
+            if session_id in self.sessions:
+                self.remove(session_id)
+            self.sessions[session_id] = session
+            self.bytes += session["size"]
+            self.evict()
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.bytes -= session["size"]
+
+    def evict(self):
+        # Sessions on disk can be loaded again after they are dropped
+        while self.bytes > self.max_bytes and len(self.sessions) > 1:
+            self.remove(next(iter(self.sessions)))
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for session_id in [session_id for session_id, session in self.sessions.items()
+                               if now - session["accessed"] > self.ttl]:
+                self.remove(session_id)
+        if self.directory and os.path.isdir(self.directory):
+            for session_id in os.listdir(self.directory):
+                path = self.get_path(session_id)
+                try:
+                    if valid_id.match(session_id) and now - os.path.getmtime(path) > self.ttl:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+sessions = SessionStore(config.session_max_bytes, config.session_ttl, config.session_directory)
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+# Helpers for files shared by the threads and processes of all workers on a
+# host. Kept free of heavy imports, the web workers use them before loading
+# TensorFlow.
+
+
+def write_atomic(path, write):
+    # Calls write(file) on a temporary file that replaces path once complete.
+    # Every writer gets its own temporary file, so concurrent writers of the
+    # same path never interleave and the last one wins.
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        # mkstemp creates files readable by their owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SqliteConnections:
+    # A connection per thread and process to a database shared by all workers
+    # on a host, sqlite connections must not be shared across threads or
+    # forks. statements create the schema of a new connection.
+
+    def __init__(self, path, statements=()):
+        self.path = path
+        self.statements = statements
+        self.local = threading.local()
+
+    def get(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.statements:
+                connection.execute(statement)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
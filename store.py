@@ -0,0 +1,223 @@
+import os
+import fcntl
+import hashlib
+import threading
+
+import numpy as np
+
+import config
+from storage import SqliteConnections
+
+# Precomputed explanations on disk. Heatmaps are appended as raw float16 or
+# uint8 arrays to heatmaps.bin and read back as memory-mapped views. An sqlite
+# index maps (image, model, method, layer, class) to their offset and shape.
+# The top predictions of every image are kept column by column in
+# top_classes.bin and top_confidences.bin, so aggregations over the whole
+# catalogue are array operations on mapped files.
+
+dtypes = ("float16", "uint8")
+top_k = 5
+
+
+def get_file_hash(data):
+    # Images are identified by their encoded file, so the app finds the
+    # explanations of an upload that a batch job precomputed
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def quantize(heatmap, dtype):
+    heatmap = np.asarray(heatmap, dtype=np.float32)
+    if dtype == "uint8":
+        return np.round(np.clip(heatmap, 0, 1) * 255).astype(np.uint8)
+    return heatmap.astype(np.float16)
+
+
+def dequantize(heatmap):
+    if heatmap.dtype == np.uint8:
+        return heatmap.astype(np.float32) / 255
+    return heatmap.astype(np.float32)
+
+
+class HeatmapStore:
+    # Safe for concurrent readers and writers of several processes: appends
+    # are serialized by a file lock and a heatmap is only indexed once its
+    # data is written
+
+    def __init__(self, path, dtype="uint8"):
+        if dtype not in dtypes:
+            raise ValueError("Unknown heatmap dtype %r, expected one of %s" % (dtype, dtypes))
+        self.path = path
+        self.dtype = dtype
+        self.connections = SqliteConnections(os.path.join(path, "index.sqlite"), [
+            "CREATE TABLE IF NOT EXISTS heatmaps ("
+            "image TEXT NOT NULL, model TEXT NOT NULL, method TEXT NOT NULL, "
+            "layer INTEGER NOT NULL, class INTEGER NOT NULL, layer_name TEXT, "
+            "offset INTEGER NOT NULL, height INTEGER NOT NULL, width INTEGER NOT NULL, "
+            "dtype TEXT NOT NULL, PRIMARY KEY (image, model, method, layer, class))",
+            "CREATE TABLE IF NOT EXISTS images ("
+            "image TEXT NOT NULL, model TEXT NOT NULL, row INTEGER NOT NULL, PRIMARY KEY (image, model))",
+            "CREATE TABLE IF NOT EXISTS class_names (class INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+        ])
+        self.lock = threading.Lock()
+        self.maps = {}
+        os.makedirs(path, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def connect(self):
+        return self.connections.get()
+
+    def append(self, name, data):
+        # Appends to a data file and returns the offset, the caller holds the
+        # write lock
+        with open(self.get_path(name), "ab") as file:
+            offset = file.seek(0, os.SEEK_END)
+            file.write(data)
+            file.flush()
+        return offset
+
+    def write_lock(self):
+        lock_file = open(self.get_path("write.lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def get_map(self, name):
+        # Read-only byte mapping of a data file, mapped again once it has grown
+        path = self.get_path(name)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        with self.lock:
+            mapped = self.maps.get(name)
+            if mapped is None or len(mapped) < size:
+                mapped = np.memmap(path, dtype=np.uint8, mode="r") if size else np.zeros(0, np.uint8)
+                self.maps[name] = mapped
+        return mapped
+
+    def contains(self, image, model, method, layer, class_index):
+        row = self.connect().execute(
+            "SELECT 1 FROM heatmaps WHERE image = ? AND model = ? AND method = ? AND layer = ? AND class = ?",
+            (image, model, method, layer, class_index)).fetchone()
+        return row is not None
+
+    def put(self, image, model, method, layer, class_index, heatmap, layer_name=None):
+        heatmap = quantize(heatmap, self.dtype)
+        connection = self.connect()
+        with self.write_lock():
+            if self.contains(image, model, method, layer, class_index):
+                return False
+            offset = self.append("heatmaps.bin", heatmap.tobytes())
+            connection.execute("INSERT INTO heatmaps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (image, model, method, layer, int(class_index), layer_name, offset,
+                                heatmap.shape[0], heatmap.shape[1], self.dtype))
+        return True
+
+    def put_predictions(self, image, model, preds, names):
+        # The top_k classes of the (1000,) predictions, names maps their
+        # class indices to display names
+        classes = np.argsort(preds)[::-1][:top_k].astype(np.int16)
+        confidences = np.asarray(preds, dtype=np.float32)[classes]
+        connection = self.connect()
+        with self.write_lock():
+            if connection.execute("SELECT 1 FROM images WHERE image = ? AND model = ?",
+                                  (image, model)).fetchone():
+                return False
+            offset = self.append("top_classes.bin", classes.tobytes())
+            self.append("top_confidences.bin", confidences.tobytes())
+            connection.execute("INSERT INTO images VALUES (?, ?, ?)", (image, model, offset // classes.nbytes))
+            connection.executemany("INSERT OR IGNORE INTO class_names VALUES (?, ?)",
+                                   [(int(class_index), names[class_index]) for class_index in classes])
+        return True
+
+    def get(self, image, model, layer, class_index=None, rank=0, method="gradcam"):
+        # Memory-mapped heatmap of a class, given by index or by its rank among
+        # the stored top predictions, or None
+        if class_index is None:
+            predictions = self.get_predictions(image, model)
+            if predictions is None:
+                return None
+            class_index = int(predictions[0][rank])
+        row = self.connect().execute(
+            "SELECT offset, height, width, dtype FROM heatmaps "
+            "WHERE image = ? AND model = ? AND method = ? AND layer = ? AND class = ?",
+            (image, model, method, layer, class_index)).fetchone()
+        if row is None:
+            return None
+        offset, height, width, dtype = row
+        data = self.get_map("heatmaps.bin")
+        nbytes = height * width * np.dtype(dtype).itemsize
+        return data[offset:offset + nbytes].view(dtype).reshape(height, width)
+
+    def get_top_columns(self):
+        # (rows, top_k) arrays of all stored predictions
+        classes = self.get_map("top_classes.bin")
+        confidences = self.get_map("top_confidences.bin")
+        rows = min(len(classes) // (2 * top_k), len(confidences) // (4 * top_k))
+        return (classes[:rows * 2 * top_k].view(np.int16).reshape(rows, top_k),
+                confidences[:rows * 4 * top_k].view(np.float32).reshape(rows, top_k))
+
+    def get_predictions(self, image, model):
+        # Top class indices and confidences of an image, or None
+        row = self.connect().execute("SELECT row FROM images WHERE image = ? AND model = ?",
+                                     (image, model)).fetchone()
+        if row is None:
+            return None
+        classes, confidences = self.get_top_columns()
+        return classes[row[0]], confidences[row[0]]
+
+    def get_class_names(self, class_indices):
+        rows = self.connect().execute(
+            "SELECT class, name FROM class_names WHERE class IN (%s)" % ",".join("?" * len(class_indices)),
+            [int(class_index) for class_index in class_indices]).fetchall()
+        return dict(rows)
+
+    def get_table(self, image, model):
+        # Rows of the predictions table of the app
+        predictions = self.get_predictions(image, model)
+        if predictions is None:
+            return None
+        classes, confidences = predictions
+        names = self.get_class_names(classes)
+        return [{"class": names.get(int(class_index), str(class_index)).replace("_", " ").title(),
+                 "confidence": round(float(confidence), 3)}
+                for class_index, confidence in zip(classes, confidences)]
+
+    def aggregate(self, model, layer, class_index, method="gradcam"):
+        # Mean heatmap of a class over all stored images of the same shape as
+        # the first one, and the number of images averaged
+        rows = self.connect().execute(
+            "SELECT offset, height, width, dtype FROM heatmaps "
+            "WHERE model = ? AND method = ? AND layer = ? AND class = ?",
+            (model, method, layer, class_index)).fetchall()
+        if not rows:
+            return None, 0
+        shape = rows[0][1:3]
+        total = np.zeros(shape, dtype=np.float64)
+        count = 0
+        for offset, height, width, dtype in rows:
+            if (height, width) != shape:
+                continue
+            data = self.get_map("heatmaps.bin")
+            nbytes = height * width * np.dtype(dtype).itemsize
+            total += dequantize(data[offset:offset + nbytes].view(dtype).reshape(height, width))
+            count += 1
+        return (total / count).astype(np.float32), count
+
+    def class_counts(self, model=None):
+        # How often every class is the top prediction, from the columns only
+        classes, _ = self.get_top_columns()
+        if model is not None:
+            rows = [row for row, in self.connect().execute("SELECT row FROM images WHERE model = ?", (model,))]
+            classes = classes[rows]
+        values, counts = np.unique(classes[:, 0], return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def stats(self):
+        connection = self.connect()
+        heatmaps = connection.execute("SELECT COUNT(*) FROM heatmaps").fetchone()[0]
+        images = connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        path = self.get_path("heatmaps.bin")
+        return {"heatmaps": heatmaps, "images": images,
+                "bytes": os.path.getsize(path) if os.path.exists(path) else 0}
+
+
+heatmap_store = HeatmapStore(config.heatmap_store, config.heatmap_store_dtype) if config.heatmap_store else None
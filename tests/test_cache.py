@@ -0,0 +1,50 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import cache
+
+
+def test_image_key():
+    img = Image.new("RGB", (8, 8), "white")
+    assert cache.image_key(img, "a", 1) == cache.image_key(img.copy(), "a", 1)
+    assert cache.image_key(img, "a", 1) != cache.image_key(img, "a", 2)
+    assert cache.image_key(img, "a") != cache.image_key(Image.new("RGB", (8, 8), "black"), "a")
+    assert cache.image_key(img) != cache.image_key(img.convert("L"))
+
+
+def test_disk_cache_round_trip(tmp_path):
+    disk = cache.DiskCache(str(tmp_path / "cache.sqlite"), 2 ** 20)
+    arrays = [np.arange(6, dtype=np.float32).reshape(2, 3), np.array([1, 2], dtype=np.uint8)]
+    assert disk.get("key") is None
+    disk.put("key", arrays)
+    loaded = disk.get("key")
+    assert len(loaded) == 2
+    for array, expected in zip(loaded, arrays):
+        assert array.dtype == expected.dtype
+        assert np.array_equal(array, expected)
+    assert disk.stats()["entries"] == 1
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    array = np.zeros(1000, dtype=np.uint8)
+    size = len(cache.serialize([array]))
+    disk = cache.DiskCache(str(tmp_path / "cache.sqlite"), 2 * size)
+    disk.put("a", [array])
+    disk.put("b", [array])
+    assert disk.put("c", [array]) == 1
+    assert disk.get("a") is None
+    assert disk.get("c") is not None
+
+
+def test_explanation_cache_memory_bound():
+    array = np.zeros(100, dtype=np.uint8)
+    explanation_cache = cache.ExplanationCache(250)
+    explanation_cache.put("a", [array])
+    explanation_cache.put("b", [array])
+    explanation_cache.get("a")
+    explanation_cache.put("c", [array])
+    assert explanation_cache.get("b") is None
+    assert explanation_cache.get("a") is not None
+    assert explanation_cache.evictions == 1
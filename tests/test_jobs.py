@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+pytest.importorskip("dash_core_components")
+pytest.importorskip("plotly")
+
+import jobs
+
+
+@pytest.fixture
+def job_store(tmp_path):
+    return jobs.JobStore(str(tmp_path), ttl=60, timeout=30)
+
+
+def test_job_key():
+    key = jobs.get_job_key("explanation", b"image", [], 1, "gradcam")
+    assert len(key) == 40
+    assert key == jobs.get_job_key("explanation", b"image", [], 1, "gradcam")
+    assert key != jobs.get_job_key("explanation", b"image", [], 1, "layercam")
+    assert key != jobs.get_job_key("occlusion", b"image", [], 1, "gradcam")
+
+
+def test_claim_deduplicates(job_store):
+    assert job_store.claim("a" * 40, "explanation")
+    assert not job_store.claim("a" * 40, "explanation")
+    job_store.update("a" * 40, "running", 0.5, "halfway")
+    assert not job_store.claim("a" * 40, "explanation")
+    job_store.update("a" * 40, "done", 1, "done")
+    assert not job_store.claim("a" * 40, "explanation")
+    assert job_store.get("a" * 40)["status"] == "done"
+
+
+def test_claim_restarts_failed_jobs(job_store):
+    job_store.claim("b" * 40, "explanation")
+    job_store.update("b" * 40, "failed", message="error")
+    assert job_store.claim("b" * 40, "explanation")
+    assert job_store.get("b" * 40)["status"] == "queued"
+
+
+def test_claim_restarts_stale_jobs(job_store):
+    job_store.claim("c" * 40, "occlusion")
+    job = job_store.get("c" * 40)
+    assert not job_store.is_stale(job)
+    assert job_store.is_stale(job, now=time.time() + 31)
+    job_store.timeout = 0
+    assert job_store.claim("c" * 40, "occlusion")
+
+
+def test_results_and_expiry(job_store):
+    key = "d" * 40
+    job_store.claim(key, "explanation")
+    job_store.write(key, "result.json", b"[]")
+    assert job_store.read(key, "result.json") == b"[]"
+    job_store.update(key, "done", 1, "done")
+    assert job_store.stats()["done"] == 1
+    job_store.ttl = 0
+    job_store.expire()
+    assert job_store.get(key) is None
+    assert job_store.read(key, "result.json") is None
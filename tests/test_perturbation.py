@@ -0,0 +1,71 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("dash_core_components")
+pytest.importorskip("plotly")
+
+import perturbation
+
+# Size of the graph in axis units, see make_img_graph
+graph_width = perturbation.img_width * perturbation.scale_factor
+graph_height = perturbation.img_height * perturbation.scale_factor
+
+
+def test_parse_path_absolute():
+    assert perturbation.parse_path("M10,20L30,40L50,60Z") == [[(10, 20), (30, 40), (50, 60)]]
+
+
+def test_parse_path_relative_and_axis_commands():
+    assert perturbation.parse_path("m10 10 l5 0 l0 5z") == [[(10, 10), (15, 10), (15, 15)]]
+    assert perturbation.parse_path("M0 0H10V10Z") == [[(0, 0), (10, 0), (10, 10)]]
+
+
+def test_parse_path_implicit_lines_and_sub_paths():
+    assert perturbation.parse_path("M0 0 10 0 10 10Z M20 20 L30 20") == [
+        [(0, 0), (10, 0), (10, 10)], [(20, 20), (30, 20)]]
+
+
+@pytest.mark.parametrize("path", ["10 20", "M10", "L1 2 3"])
+def test_parse_path_invalid(path):
+    with pytest.raises(ValueError):
+        perturbation.parse_path(path)
+
+
+def test_to_pixels_corners():
+    assert perturbation.to_pixels(0, graph_height, (600, 400)) == pytest.approx((0, 0))
+    assert perturbation.to_pixels(graph_width, 0, (600, 400)) == pytest.approx((600, 400))
+    assert perturbation.to_pixels(graph_width / 2, graph_height / 2, (600, 400)) == pytest.approx((300, 200))
+
+
+def make_rect(x0, y0, x1, y1, **style):
+    return dict({"type": "rect", "x0": x0, "y0": y0, "x1": x1, "y1": y1, "line": {"width": 0}}, **style)
+
+
+def test_apply_shapes_without_shapes():
+    img = Image.new("RGB", (100, 100), "white")
+    assert np.array_equal(np.asarray(perturbation.apply_shapes(img, [])), np.asarray(img))
+
+
+def test_apply_shapes_fills_rect():
+    img = Image.new("RGB", (100, 100), "white")
+    # the top left quarter of the graph
+    shape = make_rect(0, graph_height, graph_width / 2, graph_height / 2, fillcolor="black")
+    result = np.asarray(perturbation.apply_shapes(img, [shape]))
+    assert (result[10, 10] == 0).all()
+    assert (result[90, 90] == 255).all()
+    assert (result[10, 90] == 255).all()
+
+
+def test_apply_shapes_opacity():
+    img = Image.new("RGB", (100, 100), "white")
+    shape = make_rect(0, graph_height, graph_width, 0, fillcolor="black", opacity=0.5)
+    result = np.asarray(perturbation.apply_shapes(img, [shape]))
+    assert abs(int(result[50, 50, 0]) - 128) <= 1
+
+
+def test_update_shapes_applies_edits():
+    shapes = [make_rect(0, 0, 10, 10)]
+    updated = perturbation.update_shapes(shapes, {"shapes[0].x1": 20, "shapes[3].x1": 5})
+    assert updated[0]["x1"] == 20
+    assert shapes[0]["x1"] == 10
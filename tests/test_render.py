@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+import render
+
+
+def test_upsample_heatmap_same_size_is_a_copy():
+    heatmap = np.random.default_rng(0).random((40, 60)).astype(np.float32)
+    out = np.empty((40, 60), dtype=np.float32)
+    result = render.upsample_heatmap(heatmap, (60, 40), out=out)
+    assert result is out
+    assert np.array_equal(result, heatmap)
+
+
+def test_upsample_heatmap_constant():
+    heatmap = np.full((7, 7), 0.5, dtype=np.float32)
+    for method in render.interpolation_methods:
+        result = render.upsample_heatmap(heatmap, (50, 30), method)
+        assert result.shape == (30, 50)
+        assert np.allclose(result, 0.5, atol=1e-5)
+
+
+def test_interpolation_matrices_are_bounded(monkeypatch):
+    monkeypatch.setattr(render, "interpolation_matrices", OrderedDict())
+    monkeypatch.setattr(render, "max_interpolation_matrices", 2)
+    render.get_interpolation_matrix(7, 10, "bilinear")
+    render.get_interpolation_matrix(7, 20, "bilinear")
+    # a hit makes the first one the most recently used
+    render.get_interpolation_matrix(7, 10, "bilinear")
+    render.get_interpolation_matrix(7, 30, "bilinear")
+    assert list(render.interpolation_matrices) == [(7, 10, "bilinear"), (7, 30, "bilinear")]
+
+
+def test_interpolation_matrix_rows_sum_to_one():
+    for method in render.interpolation_methods:
+        matrix = render.get_interpolation_matrix(7, 23, method)
+        assert np.allclose(matrix.sum(axis=1), 1, atol=1e-5)
+
+
+def test_downsample_heatmap():
+    heatmap = np.ones((100, 200), dtype=np.float32)
+    assert render.downsample_heatmap(heatmap, (50, 25)).shape == (25, 50)
+    assert render.downsample_heatmap(heatmap, (400, 200)) is heatmap
@@ -0,0 +1,41 @@
+import uuid
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+import sessions
+
+
+def test_valid_id():
+    assert sessions.valid_id.match(uuid.uuid4().hex)
+    for session_id in ("", "abc", uuid.uuid4().hex.upper(), "../" + uuid.uuid4().hex[3:], uuid.uuid4().hex + "0"):
+        assert not sessions.valid_id.match(session_id)
+
+
+def test_valid_name():
+    for name in ("image.png", "gradcam-0123abcd.webp", "original", "shapes.json"):
+        assert sessions.valid_name.match(name)
+    for name in ("", ".", "..", ".hidden", "files/original", "../image.png", "a b", "a\\b"):
+        assert not sessions.valid_name.match(name)
+
+
+def test_files_are_shared_through_the_directory(tmp_path):
+    store = sessions.SessionStore(2 ** 20, 60, str(tmp_path))
+    session_id = store.create(Image.new("RGB", (8, 8), "white"))
+    assert store.put_file(session_id, "render.png", b"data")
+    assert not store.put_file(session_id, "../render.png", b"data")
+    store.set_shapes(session_id, [{"type": "rect"}])
+
+    # another worker on the same host
+    other = sessions.SessionStore(2 ** 20, 60, str(tmp_path))
+    assert other.get_file(session_id, "render.png") == b"data"
+    assert other.get_shapes(session_id) == [{"type": "rect"}]
+    assert other.get_image(session_id).size == (8, 8)
+    assert other.get_file(session_id, "missing.png") is None
+
+
+def test_unknown_session():
+    store = sessions.SessionStore(2 ** 20, 60)
+    assert store.get_image(uuid.uuid4().hex) is None
+    assert store.get_file("not a session", "image.png") is None
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import store
+
+names = ["class_%d" % i for i in range(1000)]
+
+
+def make_preds(top):
+    preds = np.zeros(1000, dtype=np.float32)
+    for rank, class_index in enumerate(top):
+        preds[class_index] = 0.5 / (rank + 1)
+    return preds
+
+
+@pytest.mark.parametrize("dtype", store.dtypes)
+def test_put_and_get(tmp_path, dtype):
+    heatmap_store = store.HeatmapStore(str(tmp_path), dtype)
+    heatmap = np.linspace(0, 1, 49, dtype=np.float32).reshape(7, 7)
+    assert heatmap_store.put("image", "model", "gradcam", 2, 281, heatmap, "top")
+    # already stored
+    assert not heatmap_store.put("image", "model", "gradcam", 2, 281, heatmap, "top")
+    stored = heatmap_store.get("image", "model", 2, class_index=281)
+    assert stored.dtype == np.dtype(dtype)
+    assert np.allclose(store.dequantize(stored), heatmap, atol=1 / 255)
+    assert heatmap_store.get("image", "model", 2, class_index=282) is None
+    assert heatmap_store.get("image", "model", 2, class_index=281, method="layercam") is None
+
+
+def test_get_by_rank_and_table(tmp_path):
+    heatmap_store = store.HeatmapStore(str(tmp_path))
+    heatmap_store.put_predictions("image", "model", make_preds([281, 285, 3, 4, 5]), names)
+    heatmap = np.ones((7, 7), dtype=np.float32)
+    heatmap_store.put("image", "model", "gradcam", 0, 285, heatmap)
+    assert heatmap_store.get("image", "model", 0, rank=1) is not None
+    assert heatmap_store.get("image", "model", 0, rank=0) is None
+    assert heatmap_store.get("other", "model", 0) is None
+
+    table = heatmap_store.get_table("image", "model")
+    assert [row["class"] for row in table] == ["Class 281", "Class 285", "Class 3", "Class 4", "Class 5"]
+    assert table[0]["confidence"] == 0.5
+    assert heatmap_store.get_table("image", "other") is None
+
+
+def test_columns_and_aggregate(tmp_path):
+    heatmap_store = store.HeatmapStore(str(tmp_path), "float16")
+    for image, top, value in [("a", [1, 2, 3, 4, 5], 0.25), ("b", [1, 3, 2, 4, 5], 0.5),
+                              ("c", [2, 1, 3, 4, 5], 0.75)]:
+        heatmap_store.put_predictions(image, "model", make_preds(top), names)
+        heatmap_store.put(image, "model", "gradcam", 0, 1, np.full((7, 7), value))
+    assert heatmap_store.class_counts() == {1: 2, 2: 1}
+    mean, count = heatmap_store.aggregate("model", 0, 1)
+    assert count == 3
+    assert np.allclose(mean, 0.5, atol=1e-3)
+    assert heatmap_store.stats()["images"] == 3
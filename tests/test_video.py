@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("tensorflow")
+
+import video
+
+
+@pytest.fixture
+def stub_model(monkeypatch):
+    # Heatmaps filled with the index of the call, no model is loaded
+    calls = []
+
+    def make_heatmaps(img_batch, pred_indices, layer_indices, model_name=None, method="gradcam"):
+        calls.append(len(img_batch))
+        return None, [np.full((len(img_batch), 7, 7), len(calls), dtype=np.float32)]
+
+    monkeypatch.setattr(video, "get_img_array", lambda img, model_name=None: np.zeros((1, 8, 8, 3)))
+    monkeypatch.setattr(video, "preprocess_input", lambda img_array, model_name=None: img_array)
+    monkeypatch.setattr(video, "make_gradcam_heatmaps_batch", make_heatmaps)
+    monkeypatch.setattr(video, "make_gradcam_output", lambda img, heatmap: img)
+    return calls
+
+
+def write_frames(directory, values):
+    for index, value in enumerate(values):
+        Image.fromarray(np.full((32, 32, 3), value, dtype=np.uint8)).save(
+            os.path.join(directory, "%03d.png" % index))
+
+
+def test_stream_gradcam_reuses_heatmaps(stub_model):
+    frames = [np.full((32, 32, 3), value, dtype=np.uint8) for value in (0, 0, 0, 255, 255, 0)]
+    stats = video.StreamStats()
+    results = list(video.stream_gradcam(iter(frames), batch_size=2, max_pending=3, stats=stats))
+    assert [explained for _, _, explained in results] == [True, False, False, True, False, True]
+    assert all(heatmap is not None for _, heatmap, _ in results)
+    assert stats.report()["frames"] == 6
+    assert stats.report()["explained"] == 3
+    assert sum(stub_model) == 3
+
+
+def test_run_over_image_directory(stub_model, tmp_path):
+    source = tmp_path / "frames"
+    source.mkdir()
+    write_frames(str(source), (0, 0, 255, 255, 0))
+    heatmaps = tmp_path / "heatmaps"
+    report = video.run(video.parse_args([str(source), "--heatmaps", str(heatmaps), "--log-every", "0"]))
+    assert report["frames"] == 5
+    assert report["explained"] == 3
+    assert sorted(os.listdir(str(heatmaps))) == ["000000.npy", "000002.npy", "000004.npy", "frames.csv"]
+    assert (heatmaps / "frames.csv").read_text().splitlines()[1:] == ["0,0", "1,0", "2,2", "3,2", "4,4"]
@@ -0,0 +1,161 @@
+import math
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+import config
+from cache import explanation_cache, image_key
+from gradcam import (check_method, get_image_signature, get_kernel, get_model, get_model_name,
+                     get_prediction_backend, get_selected_index, gradient_methods, make_gradcam_output,
+                     make_predictions_table, preprocess_input, weigh_activations)
+from metrics import instrument, timed
+from occlusion import get_patch_positions
+from render import downsample_heatmap, resize_img
+
+# Explains large images at their full resolution: the image is cut into
+# overlapping tiles of the model input size, which run through the network in
+# batches. Only one batch of tiles is in memory at a time, the heatmaps of the
+# tiles are blended into a single map of the size of the image.
+
+class_signature = tf.TensorSpec(shape=(None,), dtype=tf.int32)
+
+
+def make_class_heatmap_kernel(loaded, layer_index, method):
+    def class_heatmap_kernel(img_batch, class_indices):
+        # Unnormalized maps of one class for every tile, upsampled to the tile
+        # size, so that the tiles can be stitched on a common scale
+        with tf.GradientTape() as tape:
+            outputs = loaded.grad_model(img_batch, training=False)
+            layer_output = outputs[layer_index]
+            class_channel = tf.reduce_sum(tf.gather(outputs[-1], class_indices, batch_dims=1))
+
+        grads = tape.gradient(class_channel, layer_output)
+        heatmaps = tf.nn.relu(weigh_activations(layer_output, grads[tf.newaxis], method)[:, 0])
+        return tf.image.resize(heatmaps[..., tf.newaxis], loaded.img_size)[..., 0]
+    return class_heatmap_kernel
+
+
+def get_tile_layout(size, tile_size, overlap, max_tiles):
+    # Size the image is tiled at and the (top, left) corner of every tile.
+    # Images needing more than max_tiles tiles are scaled down until they fit,
+    # images smaller than a tile are scaled up.
+    tile_height, tile_width = tile_size
+    width, height = size
+    scale = 1.0
+    while True:
+        scaled_width = max(int(round(width * scale)), tile_width)
+        scaled_height = max(int(round(height * scale)), tile_height)
+        rows = get_patch_positions(scaled_height, tile_height, max(tile_height - overlap, 1))
+        columns = get_patch_positions(scaled_width, tile_width, max(tile_width - overlap, 1))
+        if len(rows) * len(columns) <= max_tiles or (len(rows) == 1 and len(columns) == 1):
+            break
+        scale *= min(math.sqrt(max_tiles / (len(rows) * len(columns))), 0.95)
+    positions = [(top, left) for top in rows for left in columns]
+    return (scaled_width, scaled_height), positions
+
+
+def get_window(tile_size):
+    # Weights of the pixels of a tile when blending, falling off towards the
+    # border where the receptive fields are cut off. Never zero, so that the
+    # border of the image is covered.
+    windows = [0.5 - 0.5 * np.cos(2 * np.pi * (np.arange(n) + 0.5) / n) for n in tile_size]
+    return np.outer(*windows).astype(np.float32)
+
+
+def iter_tile_batches(img, positions, tile_size, batch_size, model_name):
+    tile_height, tile_width = tile_size
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        img_batch = np.stack([np.asarray(img.crop((left, top, left + tile_width, top + tile_height)),
+                                         dtype=np.float32)
+                              for top, left in batch])
+        yield batch, preprocess_input(img_batch, model_name)
+
+
+def get_tiled_image(img, model_name):
+    img = img.convert('RGB')
+    tile_size = get_model(model_name).img_size
+    size, positions = get_tile_layout(img.size, tile_size, config.tile_overlap, config.max_tiles)
+    if size != img.size:
+        img = img.resize(size, Image.BILINEAR)
+    return img, tile_size, positions
+
+
+@instrument("tiled_predictions")
+def get_tiled_predictions(img, model_name=None):
+    # Predictions of every tile aggregated into one row: the confidence of a
+    # class is its highest confidence in any tile, so that small objects are
+    # not averaged away
+    model_name = get_model_name(model_name)
+
+    def compute():
+        tiled_img, tile_size, positions = get_tiled_image(img, model_name)
+        backend = get_prediction_backend(model_name)
+        preds = None
+        for _, img_batch in iter_tile_batches(tiled_img, positions, tile_size, config.tile_batch_size,
+                                              model_name):
+            batch_preds = backend.predict(img_batch).max(axis=0, keepdims=True)
+            preds = batch_preds if preds is None else np.maximum(preds, batch_preds)
+        return [preds]
+
+    key = image_key(img, "tiled_predictions", model_name, config.tile_overlap, config.max_tiles)
+    preds, = explanation_cache.get_or_compute(key, compute)
+    return preds
+
+
+@instrument("tiled_heatmap")
+def make_tiled_heatmap(img, class_index, layer_index=-1, model_name=None, method="gradcam"):
+    # Heatmap of class_index at the resolution the image is tiled at, scaled
+    # to 0-1 over the whole image
+    check_method(method, gradient_methods)
+    loaded = get_model(model_name)
+    layer_index = layer_index % len(loaded.layer_names)
+    tiled_img, tile_size, positions = get_tiled_image(img, model_name)
+    kernel = get_kernel(loaded, "class_heatmaps", make_class_heatmap_kernel,
+                        [get_image_signature(loaded), class_signature], layer_index, method)
+
+    window = get_window(tile_size)
+    heatmap = np.zeros(tiled_img.size[::-1], dtype=np.float32)
+    weights = np.zeros(tiled_img.size[::-1], dtype=np.float32)
+    for batch, img_batch in iter_tile_batches(tiled_img, positions, tile_size, config.tile_batch_size,
+                                              model_name):
+        class_indices = tf.fill([len(batch)], tf.constant(class_index, dtype=tf.int32))
+        tile_heatmaps = kernel(tf.convert_to_tensor(img_batch), class_indices).numpy()
+        for (top, left), tile_heatmap in zip(batch, tile_heatmaps):
+            heatmap[top:top + tile_size[0], left:left + tile_size[1]] += tile_heatmap * window
+            weights[top:top + tile_size[0], left:left + tile_size[1]] += window
+
+    np.divide(heatmap, weights, out=heatmap, where=weights > 0)
+    if heatmap.max() > 0:
+        heatmap /= heatmap.max()
+    return heatmap
+
+
+def get_tiled_heatmap(img, pred_index=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Aggregated predictions, the heatmap of the selected class among them and
+    # the index of the layer
+    model_name = get_model_name(model_name)
+    layer_index = layer_index % len(get_model(model_name).layer_names)
+    preds = get_tiled_predictions(img, model_name)
+    class_index = int(np.argsort(preds[0])[::-1][pred_index or 0])
+
+    key = image_key(img, "tiled", model_name, method, class_index, layer_index,
+                    config.tile_overlap, config.max_tiles)
+    # float16 halves the size of full resolution maps in the cache
+    heatmap, = explanation_cache.get_or_compute(
+        key, lambda: [make_tiled_heatmap(img, class_index, layer_index, model_name, method).astype(np.float16)])
+    return preds, heatmap, layer_index
+
+
+def explain_tiled(img, selected_class=None, layer_index=-1, model_name=None, method="gradcam"):
+    # Like gradcam.explain, with the aggregated predictions of the tiles and
+    # the overlay rendered at up to tiled_render_width pixels
+    img = img.convert('RGB')
+    preds, heatmap, layer = get_tiled_heatmap(img, get_selected_index(selected_class), layer_index,
+                                              model_name, method)
+    df = make_predictions_table(preds, model_name)
+    img = resize_img(img, config.tiled_render_width)
+    with timed("render", layer, img):
+        img = make_gradcam_output(img, downsample_heatmap(heatmap, img.size))
+    return df, img
@@ -5,7 +5,16 @@ from PIL import Image
 import dash_core_components as dcc
 import plotly.graph_objects as go
 
+from metrics import instrument
 
+# Size of the image graphs in pixels and the scale they are displayed at.
+# Shapes drawn into a graph are in these axis coordinates.
+img_width = 600
+img_height = 600
+scale_factor = 0.65
+
+
+@instrument("img_to_base64")
 def img_to_base64(img):
     buffered = io.BytesIO()
     img.save(buffered, format="JPEG")
@@ -14,8 +23,13 @@ def img_to_base64(img):
     return img_str
 
 
+def base64_to_bytes(img_string):
+    return base64.b64decode(img_string.split(',')[1])
+
+
+@instrument("base64_to_img")
 def base64_to_img(img_string):
-    img = Image.open(io.BytesIO(base64.b64decode(img_string.split(',')[1])))
+    img = Image.open(io.BytesIO(base64_to_bytes(img_string)))
     return img
 
 
@@ -24,24 +38,17 @@ def byte_png_to_img(img_bytes):
     return img
 
 
-def resize_img(img, max_width=800):
-    width, height = img.size
-    if width > max_width:
-        ratio = width / height
-        new_width = max_width
-        new_height = int(new_width / ratio)
-        img = img.resize((new_width, new_height))
-    return img
+@instrument("img_to_bytes")
+def img_to_bytes(img, format="PNG"):
+    buffered = io.BytesIO()
+    img.save(buffered, format=format)
+    return buffered.getvalue()
 
 
+@instrument("make_img_graph")
 def make_img_graph(img, id, drawable=False):
     fig = go.Figure()
 
-    # Constants
-    img_width = 600
-    img_height = 600
-    scale_factor = 0.65
-
     # Configure axes
     fig.update_xaxes(
         visible=False,
@@ -0,0 +1,292 @@
+import os
+import sys
+import glob
+import time
+import queue
+import argparse
+import threading
+
+import numpy as np
+from PIL import Image
+
+import config
+from cli import is_image
+from gradcam import (get_img_array, get_selected_index, make_gradcam_heatmaps_batch, make_gradcam_output,
+                     preprocess_input)
+from storage import write_atomic
+
+try:
+    # Decodes and encodes most video formats and reads cameras
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+def iter_cv2(source):
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise OSError("Cannot open %s" % source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+
+def iter_imageio(source):
+    reader = imageio.get_reader(source)
+    try:
+        for frame in reader:
+            yield np.asarray(frame)[..., :3]
+    finally:
+        reader.close()
+
+
+def iter_image_sequence(paths):
+    for path in paths:
+        yield np.asarray(Image.open(path).convert('RGB'))
+
+
+def get_fps(source, default=25.0):
+    if cv2 is not None and not os.path.isdir(source):
+        capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        capture.release()
+        if fps and fps > 0:
+            return fps
+    return default
+
+
+def iter_frames(source):
+    # RGB uint8 frames of a video file, a camera index, an image directory or
+    # a glob pattern, decoded one at a time
+    if os.path.isdir(source):
+        return iter_image_sequence(sorted(os.path.join(source, name) for name in os.listdir(source)
+                                          if is_image(name)))
+    if glob.has_magic(source):
+        return iter_image_sequence(sorted(glob.glob(source)))
+    if cv2 is not None:
+        return iter_cv2(source)
+    if imageio is not None:
+        return iter_imageio(source)
+    raise ImportError("Reading videos needs opencv-python or imageio")
+
+
+def prefetch(iterable, size):
+    # Decodes ahead in a thread, the queue bounds the frames held in memory
+    frames = queue.Queue(maxsize=size)
+    done = object()
+
+    def read():
+        try:
+            for item in iterable:
+                frames.put(item)
+        except Exception as e:
+            frames.put(e)
+        frames.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item = frames.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def get_signature(frame, size=32):
+    # Small grayscale copy of the frame in 0-1, cheap enough for every frame
+    img = Image.fromarray(frame).convert('L').resize((size, size), Image.BOX)
+    return np.asarray(img, dtype=np.float32) / 255
+
+
+class StreamStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.explained = 0
+        self.batches = 0
+
+    @property
+    def skipped(self):
+        return self.frames - self.explained
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            "frames": self.frames,
+            "explained": self.explained,
+            "skip_ratio": self.skipped / self.frames if self.frames else 0.0,
+            "fps": self.frames / elapsed if elapsed else 0.0,
+            "batches": self.batches,
+        }
+
+
+def stream_gradcam(frames, layer_index=-1, selected_class=None, model_name=None, method="gradcam",
+                   threshold=0.02, max_skip=30, batch_size=8, max_pending=None, stats=None):
+    # Yields (frame, heatmap, explained) for every frame in order. A frame is
+    # only explained when its mean absolute difference to the last explained
+    # frame, on downsampled grayscale copies, exceeds threshold or after
+    # max_skip frames in a row without. Other frames reuse the last heatmap.
+    # Changed frames are explained in batches of up to batch_size, a batch is
+    # run early once max_pending frames wait for it.
+    max_pending = max_pending or 4 * batch_size
+    selected_class = get_selected_index(selected_class)
+    stats = stats or StreamStats()
+    pending = []
+    changed = []
+    heatmap = None
+    reference = None
+    skipped = 0
+
+    def flush():
+        nonlocal heatmap
+        if changed:
+            img_batch = preprocess_input(
+                np.concatenate([get_img_array(Image.fromarray(frame), model_name) for frame in changed]),
+                model_name)
+            _, heatmaps = make_gradcam_heatmaps_batch(img_batch, [selected_class] * len(changed),
+                                                      [layer_index], model_name, method)
+            computed = iter(heatmaps[0])
+            stats.explained += len(changed)
+            stats.batches += 1
+            changed.clear()
+        for frame, explained in pending:
+            if explained:
+                heatmap = next(computed)
+            yield frame, heatmap, explained
+        pending.clear()
+
+    for frame in frames:
+        stats.frames += 1
+        signature = get_signature(frame)
+        explained = (reference is None or skipped >= max_skip
+                     or np.abs(signature - reference).mean() > threshold)
+        if explained:
+            reference = signature
+            skipped = 0
+            changed.append(frame)
+        else:
+            skipped += 1
+        pending.append((frame, explained))
+        if len(changed) >= batch_size or len(pending) >= max_pending or not changed:
+            yield from flush()
+    yield from flush()
+
+
+class OverlayWriter:
+    # Encodes the overlays as a video, with OpenCV or imageio
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            if cv2 is not None:
+                height, width = frame.shape[:2]
+                self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps,
+                                              (width, height))
+            elif imageio is not None:
+                self.writer = imageio.get_writer(self.path, fps=self.fps)
+            else:
+                raise ImportError("Writing videos needs opencv-python or imageio")
+        if cv2 is not None:
+            self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        else:
+            self.writer.append_data(frame)
+
+    def close(self):
+        if self.writer is not None:
+            if cv2 is not None:
+                self.writer.release()
+            else:
+                self.writer.close()
+
+
+def run(args):
+    stats = StreamStats()
+    writer = OverlayWriter(args.overlay, args.fps or get_fps(args.source)) if args.overlay else None
+    index_file = None
+    if args.heatmaps:
+        os.makedirs(args.heatmaps, exist_ok=True)
+        # Maps every frame to the explained frame whose heatmap it shows
+        index_file = open(os.path.join(args.heatmaps, "frames.csv"), "w")
+        index_file.write("frame,heatmap\n")
+
+    last_report = time.perf_counter()
+    explained_index = None
+    try:
+        frames = prefetch(iter_frames(args.source), args.prefetch)
+        results = stream_gradcam(frames, args.layer, args.selected_class, args.model, args.method,
+                                 args.threshold, args.max_skip, args.batch_size,
+                                 max_pending=args.max_pending, stats=stats)
+        for index, (frame, heatmap, explained) in enumerate(results):
+            if explained:
+                explained_index = index
+                if args.heatmaps:
+                    path = os.path.join(args.heatmaps, "%06d.npy" % index)
+                    write_atomic(path, lambda file: np.save(file, heatmap.astype(args.heatmap_dtype)))
+            if index_file is not None:
+                index_file.write("%d,%d\n" % (index, explained_index))
+            if writer is not None:
+                writer.write(np.asarray(make_gradcam_output(Image.fromarray(frame), heatmap)))
+            if args.log_every and time.perf_counter() - last_report > args.log_every:
+                last_report = time.perf_counter()
+                report = stats.report()
+                print("%d frames, %.1f frames/s, %.0f%% skipped"
+                      % (report["frames"], report["fps"], 100 * report["skip_ratio"]), file=sys.stderr)
+    finally:
+        if writer is not None:
+            writer.close()
+        if index_file is not None:
+            index_file.close()
+
+    report = stats.report()
+    print("Processed %d frames at %.1f frames/s, explained %d in %d batches, skip ratio %.2f"
+          % (report["frames"], report["fps"], report["explained"], report["batches"], report["skip_ratio"]))
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Stream Grad-CAM over a video file, a camera or an image sequence. Frames "
+                    "that barely changed reuse the heatmap of the last explained frame.")
+    parser.add_argument("source", help="video file, camera index, image directory or glob pattern")
+    parser.add_argument("--overlay", help="write the overlays to this video file")
+    parser.add_argument("--heatmaps", help="write the heatmaps of the explained frames to this directory")
+    parser.add_argument("--model", default=config.default_model, help="name of a model in models.registry")
+    parser.add_argument("--method", choices=["gradcam", "gradcam++", "layercam"], default="gradcam")
+    parser.add_argument("--layer", type=int, default=-1,
+                        help="index into the Grad-CAM layers of the model (default: the last one)")
+    parser.add_argument("--class", dest="selected_class", type=int, choices=range(5),
+                        help="rank of the explained class among the top 5 (default: top class)")
+    parser.add_argument("--threshold", type=float, default=0.02,
+                        help="mean absolute difference (0-1) above which a frame is explained again")
+    parser.add_argument("--max-skip", type=int, default=30,
+                        help="explain at least every n-th frame")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-pending", type=int,
+                        help="frames held back waiting for a batch (default: 4 times the batch size)")
+    parser.add_argument("--prefetch", type=int, default=32, help="frames decoded ahead")
+    parser.add_argument("--fps", type=float, help="frame rate of the overlay video (default: the source's)")
+    parser.add_argument("--heatmap-dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--log-every", type=float, default=5, help="seconds between progress reports")
+    args = parser.parse_args(argv)
+    if not args.overlay and not args.heatmaps:
+        parser.error("at least one of --overlay and --heatmaps is required")
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
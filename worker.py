@@ -0,0 +1,134 @@
+import os
+import argparse
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+
+import numpy as np
+from PIL import Image
+
+import config
+from inference import get_authkey, get_local_stats, read_arrays, remove, write_arrays
+
+# A single process owning the models, thread pools and caches for all web
+# workers on a host. Every connection is served by its own thread, so the
+# requests of different web workers end up in the same batches.
+
+
+def get_image(arrays):
+    return Image.fromarray(np.asarray(arrays[0]))
+
+
+def explanation(arrays, model_name, selected_class, layer_index, method):
+    import gradcam
+
+    preds, heatmap, layer = gradcam.get_heatmap(
+        get_image(arrays), gradcam.get_selected_index(selected_class), layer_index, model_name, method)
+    records = gradcam.make_predictions_table(preds, model_name).to_dict('records')
+    return (records, layer), [heatmap]
+
+
+def tiled(arrays, model_name, selected_class, layer_index, method):
+    import gradcam
+    from tiling import get_tiled_heatmap
+
+    preds, heatmap, layer = get_tiled_heatmap(
+        get_image(arrays), gradcam.get_selected_index(selected_class), layer_index, model_name, method)
+    records = gradcam.make_predictions_table(preds, model_name).to_dict('records')
+    return (records, layer), [heatmap]
+
+
+def predictions(arrays, model_name):
+    import gradcam
+
+    return gradcam.extract_predictions(get_image(arrays), model_name).to_dict('records'), []
+
+
+def occlusion(arrays, model_name, selected_class, patch_size, stride, fill):
+    from occlusion import occlusion_heatmap
+
+    return None, [occlusion_heatmap(get_image(arrays), selected_class, patch_size, stride, fill, model_name)]
+
+
+def layer_labels(arrays, model_name):
+    import gradcam
+
+    return gradcam.get_layer_labels(model_name), []
+
+
+def warm_up(arrays, model_name):
+    import gradcam
+
+    gradcam.warm_up(model_name)
+    return None, []
+
+
+def stats(arrays):
+    return get_local_stats(), []
+
+
+methods = {
+    "explanation": explanation,
+    "tiled": tiled,
+    "predictions": predictions,
+    "occlusion": occlusion,
+    "layer_labels": layer_labels,
+    "warm_up": warm_up,
+    "stats": stats,
+}
+
+
+def serve(connection):
+    with connection:
+        while True:
+            try:
+                method, args, inputs = connection.recv()
+            except (OSError, EOFError):
+                return
+            try:
+                arrays = read_arrays(*inputs) if inputs is not None else []
+                value, outputs = methods[method](arrays, *args)
+                # The client removes the file once it has mapped the outputs
+                reply = ("ok", value, write_arrays(outputs) if outputs else None)
+            except Exception as e:
+                reply = ("error", "%s: %s" % (type(e).__name__, e), None)
+            try:
+                connection.send(reply)
+            except (OSError, EOFError):
+                if reply[2] is not None:
+                    remove(reply[2][0])
+                return
+
+
+def run(address):
+    if os.path.exists(address):
+        # left over from a previous run
+        os.remove(address)
+    authkey = get_authkey(address, create=True)
+    # Only the user running the worker may connect, the socket is created
+    # without access for others
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family="AF_UNIX", backlog=64, authkey=authkey)
+    finally:
+        os.umask(umask)
+    os.chmod(address, 0o600)
+    with listener:
+        print("Inference worker listening on %s" % address, flush=True)
+        if config.warm_up:
+            threading.Thread(target=warm_up, args=([], None), daemon=True).start()
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, AuthenticationError):
+                continue
+            threading.Thread(target=serve, args=(connection,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run the models for all web workers on this host, which connect "
+                    "through GRADCAM_INFERENCE_SOCKET.")
+    parser.add_argument("--socket", default=config.inference_socket or "gradcam.sock",
+                        help="path of the Unix socket")
+    run(parser.parse_args().socket)